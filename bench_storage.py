@@ -0,0 +1,354 @@
+"""
+Storage microbenchmarks: times main.py's db_* functions against a temporary
+SQLite file filled to production-like size, under concurrent asyncio load.
+
+    python bench_storage.py                         # 1M actions, 32 concurrent callers
+    python bench_storage.py --rows 5000000 --concurrency 64
+    python bench_storage.py --db big.db             # keep the filled file and reuse it next time
+    python bench_storage.py --json > before.json    # diff schema/index changes
+
+Reports ops/s and p50/p99 per call, WAL checkpoint cost while readers are
+running, and EXPLAIN QUERY PLAN for the hot queries. Never touches DB_PATH.
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from toolenv import placeholder_env, pct
+
+# share of each status in a long-running ledger; the rest is 'sent'
+STATUS_MIX = {"failed": 0.06, "cancelled": 0.04, "pending": 0.03, "scheduled": 0.01, "sending": 0.001}
+DAY = 86400
+
+
+def fill(path: str, rows: int, admins: int, days: int, seed: int) -> dict:
+    """Bulk-loads actions + action_attempts with plain sqlite3 (the schema comes from main.db_init)."""
+    import main
+
+    rnd = random.Random(seed)
+    gifts = list(main.GIFTS_BY_ID.values())
+    # a few heavy creators, long tail of light ones
+    weights = [1 / (i + 1) for i in range(admins)]
+    creators = list(range(1_000_000, 1_000_000 + admins))
+    statuses = ["sent"] + list(STATUS_MIX)
+    status_w = [1 - sum(STATUS_MIX.values())] + list(STATUS_MIX.values())
+    now = int(time.time())
+    t0 = now - days * DAY
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=OFF;")
+    counts: Dict[str, int] = {}
+
+    def gen(start: int, n: int):
+        for i in range(start, start + n):
+            g = rnd.choice(gifts)
+            st = rnd.choices(statuses, status_w)[0]
+            counts[st] = counts.get(st, 0) + 1
+            created = t0 + (i * days * DAY) // rows
+            send_at = now + rnd.randint(60, 30 * DAY) if st == "scheduled" else None
+            yield (
+                rnd.choices(creators, weights)[0], rnd.choice((None, -1001234567890)), "@someone",
+                g.id, g.stars, rnd.choice((None, "gl hf")), rnd.randint(0, 1), st,
+                "RPCError" if st == "failed" else None, send_at, None, created, created + 5,
+            )
+
+    batch = 50_000
+    for start in range(0, rows, batch):
+        con.executemany("""
+            INSERT INTO actions(creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, error,
+                                send_at, bot_id, created_at, updated_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, gen(start, min(batch, rows - start)))
+    # one charge attempt per settled row, like the retry engine leaves behind
+    con.execute("""
+        INSERT INTO action_attempts(action_id, attempt, step, outcome, error, created_at, updated_at)
+        SELECT action_id, 1, 'charge', CASE status WHEN 'sent' THEN 'ok' ELSE 'error' END, error,
+               updated_at, updated_at
+        FROM actions WHERE status IN ('sent', 'failed')
+    """)
+    con.executemany(
+        "INSERT OR IGNORE INTO admins(user_id, role, lang, created_at) VALUES(?,?,?,?)",
+        [(uid, "admin", "en", t0) for uid in creators],
+    )
+    con.commit()
+    con.execute("ANALYZE;")
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    con.close()
+    return counts
+
+
+def ids_with_status(path: str, status: str, limit: int) -> List[int]:
+    con = sqlite3.connect(path)
+    try:
+        return [r[0] for r in con.execute(
+            "SELECT action_id FROM actions WHERE status=? ORDER BY random() LIMIT ?", (status, limit))]
+    finally:
+        con.close()
+
+
+def snapshot_rows(path: str, ids: List[int]) -> List[tuple]:
+    con = sqlite3.connect(path)
+    try:
+        return [r for a in ids for r in con.execute(
+            "SELECT status, locked_by, error, updated_at, action_id FROM actions WHERE action_id=?", (a,))]
+    finally:
+        con.close()
+
+
+def restore(path: str, rows: List[tuple], max_id: int):
+    """Puts benched rows back and drops what the run created, so a reused --db keeps its mix."""
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        con.executemany("UPDATE actions SET status=?, locked_by=?, error=?, updated_at=? WHERE action_id=?", rows)
+        con.execute("DELETE FROM action_attempts WHERE action_id > ?", (max_id,))
+        con.execute("DELETE FROM actions WHERE action_id > ?", (max_id,))
+        con.commit()
+    finally:
+        con.close()
+
+
+async def bench(name: str, calls: List[Callable[[], Awaitable]], concurrency: int) -> dict:
+    lat: List[float] = []
+    it = iter(calls)
+
+    async def worker():
+        for call in it:
+            t = time.perf_counter()
+            await call()
+            lat.append((time.perf_counter() - t) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+    return {
+        "name": name,
+        "n": len(lat),
+        "ops_s": round(len(lat) / wall, 1) if wall else 0.0,
+        "p50": round(pct(lat, 50), 2),
+        "p99": round(pct(lat, 99), 2),
+        "max": round(max(lat), 2) if lat else 0.0,
+    }
+
+
+async def checkpoint_under_load(path: str, max_id: int, concurrency: int, writes: int) -> dict:
+    """Builds up WAL with real writes, then checkpoints while readers keep calling db_get_action."""
+    import main
+
+    gift = next(iter(main.GIFTS_BY_ID.values()))
+    # the last connection to close checkpoints and deletes the WAL; keep one open so it builds up
+    keeper = sqlite3.connect(path)
+    keeper.execute("SELECT 1 FROM actions LIMIT 1").fetchall()
+    w = await bench("db_create_action (wal fill)", [
+        lambda: main.db_create_action(1_000_000, None, "@someone", gift, None, 0) for _ in range(writes)
+    ], concurrency)
+    wal_bytes = os.path.getsize(path + "-wal") if os.path.exists(path + "-wal") else 0
+
+    stop = asyncio.Event()
+    lat: List[float] = []
+
+    async def reader():
+        while not stop.is_set():
+            t = time.perf_counter()
+            await main.db_get_action(random.randint(1, max_id))
+            lat.append((time.perf_counter() - t) * 1000)
+
+    readers = [asyncio.create_task(reader()) for _ in range(concurrency)]
+    await asyncio.sleep(0.5)
+    before = list(lat)
+    lat.clear()
+
+    def _checkpoint() -> tuple:
+        con = sqlite3.connect(path, timeout=30)
+        try:
+            t = time.perf_counter()
+            busy = con.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()[0]
+            return (time.perf_counter() - t) * 1000, busy
+        finally:
+            con.close()
+
+    ms, busy = await asyncio.to_thread(_checkpoint)
+    keeper.close()
+    await asyncio.sleep(0.2)
+    stop.set()
+    await asyncio.gather(*readers)
+    return {
+        "writes": w,
+        "wal_bytes": wal_bytes,
+        "checkpoint_ms": round(ms, 2),
+        "busy": busy,
+        "reader_p99_before": round(pct(before, 99), 2),
+        "reader_p99_during": round(pct(lat, 99), 2),
+    }
+
+
+PLANS = {
+    "db_get_action": "SELECT * FROM actions WHERE action_id=?",
+    "db_try_lock_sending": "UPDATE actions SET status='sending' WHERE action_id=? AND status='pending'",
+    "db_next_scheduled": "SELECT send_at, action_id FROM actions WHERE status='scheduled' ORDER BY send_at LIMIT 100",
+    "db_recover_orphans": "SELECT action_id FROM actions WHERE status='sending'",
+    "db_charge_state": "SELECT outcome FROM action_attempts WHERE action_id=? AND step='charge'",
+    "by_creator": "SELECT action_id FROM actions WHERE creator_id=? ORDER BY created_at DESC LIMIT 20",
+    "db_iter_actions": "SELECT * FROM actions INDEXED BY idx_actions_created "
+                       "WHERE created_at >= ? AND created_at < ? ORDER BY created_at, action_id",
+}
+
+
+def query_plans(path: str) -> Dict[str, List[str]]:
+    con = sqlite3.connect(path)
+    try:
+        out = {}
+        for name, sql in PLANS.items():
+            args = (1,) * sql.count("?")
+            out[name] = [r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql, args)]
+        return out
+    finally:
+        con.close()
+
+
+async def run(args, path: str) -> dict:
+    import main
+
+    await main.db_init()
+    counts = None
+    con = sqlite3.connect(path)
+    have = con.execute("SELECT COUNT(*) FROM actions").fetchone()[0]
+    con.close()
+    if have < args.rows:
+        t = time.perf_counter()
+        counts = fill(path, args.rows - have, args.admins, args.days, args.seed)
+        print(f"filled {args.rows - have} rows in {time.perf_counter() - t:.1f}s", file=sys.stderr)
+    con = sqlite3.connect(path)
+    max_id = con.execute("SELECT MAX(action_id) FROM actions").fetchone()[0]
+    con.close()
+
+    n, c = args.ops, args.concurrency
+    rnd = random.Random(args.seed)
+    creators = list(range(1_000_000, 1_000_000 + args.admins))
+    pending = ids_with_status(path, "pending", n)
+    # the lock/mark benches flip these; restored (and the wal-fill rows dropped) at the end
+    saved = snapshot_rows(path, pending)
+    try:
+        results = []
+        # db_connect() opens a connection per call; with none left open each close is a full
+        # checkpoint + WAL delete. --hold-open shows what a long-lived connection would change.
+        keeper = sqlite3.connect(path) if args.hold_open else None
+        if keeper:
+            keeper.execute("SELECT 1 FROM actions LIMIT 1").fetchall()
+
+        async def by_creator(uid: int):
+            async with main.db_connect() as db:
+                cur = await db.execute(
+                    "SELECT action_id, status FROM actions WHERE creator_id=? ORDER BY created_at DESC LIMIT 20", (uid,))
+                await cur.fetchall()
+
+        async def export_day(day: int):
+            async for _ in main.db_iter_actions(day, day + DAY, main.EXPORT_CHUNK_ROWS):
+                pass
+
+        async def orphan_scan(alive_since: int):
+            # db_recover_orphans' candidate query without the settling writes: the filled
+            # 'sending' rows would all be rewritten by the first call and the rest would time nothing
+            async with main.db_connect() as db:
+                await main._orphan_rows(db, alive_since)
+
+        async def count_status(st: str):
+            async with main.db_connect() as db:
+                cur = await db.execute("SELECT COUNT(*) FROM actions WHERE status=?", (st,))
+                await cur.fetchone()
+
+        results.append(await bench("db_get_action", [
+            (lambda a=rnd.randint(1, max_id): main.db_get_action(a)) for _ in range(n)], c))
+        results.append(await bench("db_try_lock_sending", [
+            (lambda a=a: main.db_try_lock_sending(a)) for a in pending], c))
+        # second click on the same rows: the lock must lose without writing
+        results.append(await bench("db_try_lock_sending (taken)", [
+            (lambda a=a: main.db_try_lock_sending(a)) for a in pending], c))
+        results.append(await bench("db_mark_action", [
+            (lambda a=a: main.db_mark_action(a, "sent")) for a in pending], c))
+        results.append(await bench("db_charge_state", [
+            (lambda a=rnd.randint(1, max_id): main.db_charge_state(a)) for _ in range(n)], c))
+        results.append(await bench("by_creator (idx_actions_creator)", [
+            (lambda u=rnd.choice(creators): by_creator(u)) for _ in range(n)], c))
+        results.append(await bench("count by status (idx_actions_status)", [
+            (lambda s=rnd.choice(("pending", "scheduled", "sending")): count_status(s)) for _ in range(n // 10)], c))
+        results.append(await bench("db_next_scheduled", [
+            (lambda: main.db_next_scheduled(main.SCHED_WINDOW)) for _ in range(n // 10)], c))
+        # with no instances row the lease subquery is empty; scan as a live, booted instance would
+        alive_since = int(time.time() - 3 * main.INSTANCE_HEARTBEAT)
+        await main.db_heartbeat(alive_since)
+        results.append(await bench("orphan scan (db_recover_orphans)", [
+            (lambda: orphan_scan(alive_since)) for _ in range(n // 10)], c))
+        results.append(await bench("db_iter_actions (1 day)", [
+            (lambda d=int(time.time()) - rnd.randint(1, args.days) * DAY: export_day(d)) for _ in range(max(1, n // 100))], c))
+        if keeper:
+            keeper.close()
+
+        checkpoint = await checkpoint_under_load(path, max_id, c, n)
+    finally:
+        restore(path, saved, max_id)
+        await main.db_drop_instance()
+    return {
+        "rows": args.rows,
+        "filled": counts,
+        "concurrency": c,
+        "hold_open": args.hold_open,
+        "db_bytes": os.path.getsize(path),
+        "results": results,
+        "checkpoint": checkpoint,
+        "plans": query_plans(path),
+    }
+
+
+def print_report(r: dict):
+    print(f"rows: {r['rows']}  db: {r['db_bytes'] / 1e6:.1f} MB  concurrency: {r['concurrency']}"
+          f"  hold-open: {r['hold_open']}")
+    if r["filled"]:
+        print("status mix:", ", ".join(f"{k}={v}" for k, v in sorted(r["filled"].items())))
+    print(f"\n  {'call':<40}{'n':>7}{'ops/s':>10}{'p50':>9}{'p99':>9}{'max':>9}")
+    for x in r["results"]:
+        print(f"  {x['name']:<40}{x['n']:>7}{x['ops_s']:>10}{x['p50']:>9}{x['p99']:>9}{x['max']:>9}")
+    ck = r["checkpoint"]
+    w = ck["writes"]
+    print(f"  {w['name']:<40}{w['n']:>7}{w['ops_s']:>10}{w['p50']:>9}{w['p99']:>9}{w['max']:>9}")
+    print(f"\nwal checkpoint: {ck['wal_bytes'] / 1e6:.2f} MB in {ck['checkpoint_ms']} ms"
+          f" (busy={ck['busy']}); reader p99 {ck['reader_p99_before']} -> {ck['reader_p99_during']} ms")
+    print("\nquery plans:")
+    for name, plan in r["plans"].items():
+        print(f"  {name}: {' | '.join(plan)}")
+
+
+def cli(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=1_000_000, help="actions in the table")
+    ap.add_argument("--admins", type=int, default=200, help="distinct creators (skewed)")
+    ap.add_argument("--days", type=int, default=365, help="created_at spread")
+    ap.add_argument("--ops", type=int, default=2000, help="calls per benchmark")
+    ap.add_argument("--concurrency", type=int, default=32, help="concurrent callers")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--hold-open", action="store_true", help="keep one idle connection open during the run")
+    ap.add_argument("--db", help="SQLite file to fill and keep (default: temporary); topped up to --rows")
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, "bench.db")
+        placeholder_env(path)
+        report = asyncio.run(run(args, path))
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,47 +1,166 @@
 import os
+import re
+import copy
+import hmac
+import hashlib
+import io
+import json
+import queue
+import atexit
 import asyncio
+import argparse
+import csv
+import functools
+import gzip
+import heapq
 import logging
+import logging.handlers
+import math
+import cProfile
+import pstats
+import random
+import signal
+import socket
+import tempfile
 import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple, Union
-from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from contextlib import asynccontextmanager, contextmanager
 
 import aiosqlite
 from dotenv import load_dotenv
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.types import (
-    Message, CallbackQuery,
+    Update, Message, CallbackQuery,
     InlineKeyboardMarkup,
     InlineQuery, InlineQueryResultArticle,
     InputTextMessageContent,
+    FSInputFile,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 from telethon import TelegramClient, functions, types
 from telethon.sessions import StringSession
-from telethon.errors import RPCError
+from telethon.errors import (
+    RPCError, FloodWaitError, FloodPremiumWaitError,
+    ServerError, TimedOutError, RpcCallFailError,
+)
 
 
 # =========================
 # Logging
 # =========================
-logging.basicConfig(
-    level=os.getenv("LOG_LEVEL", "INFO"),
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-)
+# action_id / update_id of whatever the current task is working on
+trace_id_var: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "trace_id"}
+
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "trace_id", None):
+            out["trace_id"] = record.trace_id
+        for k, v in vars(record).items():
+            if k not in _LOG_RECORD_FIELDS:
+                out[k] = v
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class _LoopSafeQueueHandler(logging.handlers.QueueHandler):
+    # default prepare() flattens everything into msg; keep extras for JsonFormatter
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """The event loop only enqueues records; a listener thread does the actual writes."""
+    out = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "json").lower() == "json":
+        out.setFormatter(JsonFormatter())
+    else:
+        out.setFormatter(logging.Formatter(
+            "%(asctime)s | %(levelname)s | %(name)s | %(trace_id)s | %(message)s"
+        ))
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    qh = _LoopSafeQueueHandler(q)
+    qh.addFilter(TraceIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [qh]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+load_dotenv()  # logging'dan oldin: .env'dagi LOG_FORMAT / LOG_LEVEL ham ishlasin
+log_listener = setup_logging()
 log = logging.getLogger("giftbot")
 
 
+@contextmanager
+def trace(trace_id: str):
+    token = trace_id_var.set(trace_id)
+    try:
+        yield
+    finally:
+        trace_id_var.reset(token)
+
+
+@contextmanager
+def timed(step: str, level: int = logging.INFO):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        log.log(level, "step %s", step, extra={"step": step, "ms": round((time.perf_counter() - t0) * 1000, 1)})
+
+
+def traced_db(fn):
+    # db_* chaqiruvlari trace_id bilan DEBUG logga tushadi
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with timed(fn.__name__, logging.DEBUG):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+
 # =========================
 # ENV
 # =========================
-load_dotenv()
-
-
+# .env is loaded above, before setup_logging()
 def env_required(name: str) -> str:
     v = os.getenv(name)
     if not v:
@@ -49,10 +168,21 @@ def env_required(name: str) -> str:
     return v
 
 
-BOT_TOKEN = env_required("BOT_TOKEN")
-TG_API_ID = int(env_required("TG_API_ID"))
-TG_API_HASH = env_required("TG_API_HASH")
-RELAYER_SESSION = env_required("RELAYER_SESSION")
+# Multi-tenant: BOT_TOKENS=tok1,tok2,... runs several bots on one dispatcher,
+# one relayer and one DB. Without it, BOT_TOKEN alone as before.
+# Bot/relayer secrets are required by main() only: `python main.py export` needs just DB_PATH.
+BOT_TOKENS = [t.strip() for t in (os.getenv("BOT_TOKENS") or os.getenv("BOT_TOKEN", "")).split(",") if t.strip()]
+TG_API_ID = int(os.getenv("TG_API_ID") or 0)
+TG_API_HASH = os.getenv("TG_API_HASH", "")
+RELAYER_SESSION = os.getenv("RELAYER_SESSION", "")
+
+
+def require_bot_env():
+    if not BOT_TOKENS:
+        env_required("BOT_TOKEN")
+    for name in ("TG_API_ID", "TG_API_HASH", "RELAYER_SESSION"):
+        env_required(name)
+
 
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
@@ -62,6 +192,77 @@ DEFAULT_LANG = os.getenv("DEFAULT_LANG", "ru").strip().lower()
 if DEFAULT_LANG not in ("uz", "ru", "en"):
     DEFAULT_LANG = "ru"
 
+# Scheduled gifts: times in /gift ... at <time> are read in this zone
+BOT_TZ = ZoneInfo(os.getenv("BOT_TZ", "UTC"))
+SCHED_WINDOW = int(os.getenv("SCHED_WINDOW", "100"))          # next-due actions kept in memory
+SCHED_IDLE_RELOAD = int(os.getenv("SCHED_IDLE_RELOAD", "600"))  # safety reload when nothing is due
+
+# Relayer retry engine
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+RETRY_MAX_FLOOD_WAIT = int(os.getenv("RETRY_MAX_FLOOD_WAIT", "600"))  # longer flood waits fail the action
+
+# Relayer keepalive
+RELAYER_PING_INTERVAL = float(os.getenv("RELAYER_PING_INTERVAL", "45"))
+RELAYER_WARM_EVERY = int(os.getenv("RELAYER_WARM_EVERY", "10"))  # every Nth ping also touches payments
+RELAYER_READY_TIMEOUT = float(os.getenv("RELAYER_READY_TIMEOUT", "10"))
+
+# Inline mode: wait this long for the next keystroke before doing any work
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.4"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "10"))        # results hold live action ids
+INLINE_HELP_CACHE_TIME = int(os.getenv("INLINE_HELP_CACHE_TIME", "300"))
+
+# Outbound edits (Bot API flood limits: ~30/s per bot, ~1/s per private chat, ~20/min per group)
+EDIT_GLOBAL_RATE = float(os.getenv("EDIT_GLOBAL_RATE", "25"))
+EDIT_PRIVATE_RATE = float(os.getenv("EDIT_PRIVATE_RATE", "1"))
+EDIT_GROUP_RATE = float(os.getenv("EDIT_GROUP_RATE", "20")) / 60
+EDIT_MAX_RETRIES = int(os.getenv("EDIT_MAX_RETRIES", "3"))
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", "5000"))  # messages whose last render we remember
+
+# Opt-in traffic recording for replay.py (JSONL, user/chat ids anonymized)
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "").strip()
+RECORD_SALT = os.getenv("RECORD_SALT", "") or os.urandom(16).hex()
+
+# /profile (owner only)
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+
+# Ledger export (/export and `python main.py export`)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+EXPORT_MAX_UPLOAD = 50 * 1024 * 1024  # Bot API document limit
+
+# Admin menu settings are group-committed at most this often
+SETTINGS_FLUSH_INTERVAL = float(os.getenv("SETTINGS_FLUSH_INTERVAL", "0.5"))
+
+# Graceful shutdown: on SIGTERM stop polling, let in-flight sends finish for up to
+# DRAIN_TIMEOUT (Heroku kills 30s after SIGTERM), then hand over to the next instance.
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+INSTANCE_HEARTBEAT = float(os.getenv("INSTANCE_HEARTBEAT", "10"))  # 3 missed => 'sending' rows are orphans
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{int(time.time())}"
+
+# Admin ids are kept in memory; strangers' updates never reach SQLite
+ADMIN_REFRESH = float(os.getenv("ADMIN_REFRESH", "60"))  # admins are added straight in the DB
+
+# Local HTTP server (aiohttp): GET /events streams action lifecycle as SSE. 0 = off.
+HTTP_HOST = os.getenv("HTTP_HOST", "127.0.0.1")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "0"))
+EVENTS_BACKLOG = int(os.getenv("EVENTS_BACKLOG", "1000"))  # kept for Last-Event-ID resume
+SSE_QUEUE = int(os.getenv("SSE_QUEUE", "256"))            # per subscriber; overflow drops the client
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+
+# Ingestion API on the same server (POST /api/actions); off without API_TOKEN.
+# When set, every route on the server (/events, /stats too) needs "Authorization: Bearer <token>".
+API_TOKEN = os.getenv("API_TOKEN", "").strip()
+API_CREATOR_ID = int(os.getenv("API_CREATOR_ID", str(OWNER_ID)))  # actions are created on behalf of
+API_MAX_BATCH = int(os.getenv("API_MAX_BATCH", "100"))
+
+# Send backpressure: the relayer sends one gift at a time, so cap the line in front of it.
+# Clicks over either limit get "busy, try again in N s" instead of waiting.
+SEND_MAX_QUEUE = int(os.getenv("SEND_MAX_QUEUE", "20"))
+SEND_MAX_WAIT = float(os.getenv("SEND_MAX_WAIT", "30"))
+SEND_EST_INIT = float(os.getenv("SEND_EST_INIT", "3"))  # seconds per send until measured
+
 
 # =========================
 # i18n
@@ -98,6 +299,10 @@ TR = {
         "reply_need": "⚠️ В группе используйте reply: ответьте на человека и напишите /gift 50 коммент\nИли укажите цель: /gift 50 @username коммент",
         "reply_fetch_fail": "⚠️ Не смог найти reply-сообщение.\nПроверьте:\n1) Relayer аккаунт должен быть в этом чате\n2) Сообщение reply не удалено",
         "err": "❌ Ошибка: {e}",
+        "scheduled": "🕒 Запланировано на {at}",
+        "bad_time": "⚠️ Время уже прошло. Примеры: at 18:30, at 2026-12-31 23:59, at +2h",
+        "restarting": "🔄 Бот перезапускается, нажмите ещё раз через минуту.",
+        "busy": "⏳ Очередь отправки заполнена, попробуйте через {s} с.",
     },
     "uz": {
         "no_access": "⛔ Ruxsat yo‘q.",
@@ -130,6 +335,10 @@ TR = {
         "reply_need": "⚠️ Guruhda reply qilib ishlating: odamga reply qiling va /gift 50 komment\nYoki target yozing: /gift 50 @username komment",
         "reply_fetch_fail": "⚠️ Reply message topilmadi.\nTekshiring:\n1) Relayer akkaunt shu guruhda bo‘lsin\n2) Reply qilingan habar o‘chmagan bo‘lsin",
         "err": "❌ Xatolik: {e}",
+        "scheduled": "🕒 {at} ga rejalashtirildi",
+        "bad_time": "⚠️ Vaqt o‘tib ketgan. Misol: at 18:30, at 2026-12-31 23:59, at +2h",
+        "restarting": "🔄 Bot qayta ishga tushmoqda, bir daqiqadan so‘ng yana bosing.",
+        "busy": "⏳ Yuborish navbati to‘la, {s} soniyadan so‘ng urinib ko‘ring.",
     },
     "en": {
         "no_access": "⛔ No access.",
@@ -162,6 +371,10 @@ TR = {
         "reply_need": "⚠️ In groups: reply to user and type /gift 50 comment\nOr provide target: /gift 50 @username comment",
         "reply_fetch_fail": "⚠️ Could not fetch the replied message.\nCheck:\n1) Relayer account must be in that chat\n2) The replied message is not deleted",
         "err": "❌ Error: {e}",
+        "scheduled": "🕒 Scheduled for {at}",
+        "bad_time": "⚠️ That time is in the past. Examples: at 18:30, at 2026-12-31 23:59, at +2h",
+        "restarting": "🔄 Restarting, press again in a minute.",
+        "busy": "⏳ Send queue is full, try again in {s}s.",
     },
 }
 
@@ -218,9 +431,88 @@ def gifts_up_to(max_stars: int) -> List[GiftItem]:
     return out
 
 
+# =========================
+# Action events
+# =========================
+class Subscriber:
+    def __init__(self, size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.backlog: List[dict] = []
+        self.gap = False  # Last-Event-ID was older than the backlog (or from another process)
+
+
+class EventBus:
+    """
+    In-process pub/sub for action lifecycle changes, published by the db_* writers
+    right after commit. The last EVENTS_BACKLOG events are kept so a reconnecting
+    client can resume; a subscriber whose queue fills up is cut off, not waited for.
+    """
+
+    def __init__(self, backlog: int, queue_size: int):
+        self.queue_size = queue_size
+        self.epoch = f"{int(time.time()):x}"  # ids don't survive a restart
+        self.seq = 0
+        self._ring: deque = deque(maxlen=backlog)
+        self._subs: set[Subscriber] = set()
+        self.dropped = 0
+
+    def publish(self, action_id: int, status: str, **fields):
+        self.seq += 1
+        ev = {"id": f"{self.epoch}-{self.seq}", "action_id": action_id, "status": status,
+              "ts": int(time.time()), **fields}
+        self._ring.append((self.seq, ev))
+        for sub in list(self._subs):
+            try:
+                sub.queue.put_nowait(ev)
+            except asyncio.QueueFull:
+                self._cut(sub)
+
+    def _cut(self, sub: Subscriber):
+        self._subs.discard(sub)
+        self.dropped += 1
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)  # handler sends `overflow` and closes
+
+    def subscribe(self, last_id: Optional[str] = None) -> Subscriber:
+        sub = Subscriber(self.queue_size)
+        if last_id:
+            epoch, _, seq = last_id.partition("-")
+            if epoch == self.epoch and seq.isdigit():
+                after = int(seq)
+                sub.backlog = [e for n, e in self._ring if n > after]
+                oldest = self._ring[0][0] if self._ring else self.seq + 1
+                sub.gap = oldest > after + 1
+            else:
+                sub.gap = True
+        self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        self._subs.discard(sub)
+
+    def __len__(self) -> int:
+        return len(self._subs)
+
+
+events = EventBus(EVENTS_BACKLOG, SSE_QUEUE)
+
+
 # =========================
 # DB
 # =========================
+# connections opened / write transactions / rows changed (replay.py reports these)
+DB_STATS = {"connections": 0, "writes": 0, "changes": 0}
+# action ids created while handling the current update (recorder / replay.py remap callbacks by it)
+created_ids_var: ContextVar[Optional[List[int]]] = ContextVar("created_ids", default=None)
+
+
+def _note_created(ids: List[int]):
+    sink = created_ids_var.get()
+    if sink is not None:
+        sink.extend(ids)
+
+
 @asynccontextmanager
 async def db_connect():
     async with aiosqlite.connect(DB_PATH) as db:
@@ -228,9 +520,25 @@ async def db_connect():
         await db.execute("PRAGMA synchronous=NORMAL;")
         await db.execute("PRAGMA foreign_keys=ON;")
         await db.execute("PRAGMA busy_timeout=5000;")
-        yield db
+        DB_STATS["connections"] += 1
+        try:
+            yield db
+        finally:
+            changes = db.total_changes
+            if changes:
+                DB_STATS["writes"] += 1
+                DB_STATS["changes"] += changes
 
 
+async def _db_add_column(db: aiosqlite.Connection, table: str, column: str, decl: str):
+    # eski bazalar uchun: CREATE TABLE IF NOT EXISTS yangi ustunlarni qo'shmaydi
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    cols = {r[1] for r in await cur.fetchall()}
+    if column not in cols:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+@traced_db
 async def db_init():
     async with db_connect() as db:
         await db.execute("""
@@ -255,14 +563,50 @@ async def db_init():
             stars INTEGER NOT NULL,
             comment TEXT DEFAULT NULL,
             hide_name INTEGER NOT NULL DEFAULT 0,
-            status TEXT NOT NULL DEFAULT 'pending',  -- pending|sending|sent|cancelled|failed
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending|scheduled|sending|sent|cancelled|failed
+            error TEXT DEFAULT NULL,
+            send_at INTEGER DEFAULT NULL,   -- unix ts, only for status='scheduled'
+            bot_id INTEGER DEFAULT NULL,    -- which bot token created it (multi-tenant)
+            locked_by TEXT DEFAULT NULL,    -- INSTANCE_ID that moved it to 'sending'
+            idempotency_key TEXT DEFAULT NULL,  -- HTTP API callers' retry key
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        );
+        """)
+        await _db_add_column(db, "actions", "send_at", "INTEGER DEFAULT NULL")
+        await _db_add_column(db, "actions", "bot_id", "INTEGER DEFAULT NULL")
+        await _db_add_column(db, "actions", "locked_by", "TEXT DEFAULT NULL")
+        await _db_add_column(db, "actions", "idempotency_key", "TEXT DEFAULT NULL")
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS action_attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action_id INTEGER NOT NULL,
+            attempt INTEGER NOT NULL,
+            step TEXT NOT NULL,       -- last step reached: start|check|resolve|form|charge
+            outcome TEXT NOT NULL,    -- started|ok|rejected|unknown|error
             error TEXT DEFAULT NULL,
             created_at INTEGER NOT NULL,
             updated_at INTEGER NOT NULL
         );
         """)
+        await db.execute("""
+        CREATE TABLE IF NOT EXISTS instances (
+            instance_id TEXT PRIMARY KEY,
+            started_at INTEGER NOT NULL,
+            heartbeat_at INTEGER NOT NULL
+        );
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_attempts_action ON action_attempts(action_id);")
         await db.execute("CREATE INDEX IF NOT EXISTS idx_actions_status ON actions(status);")
         await db.execute("CREATE INDEX IF NOT EXISTS idx_actions_creator ON actions(creator_id);")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_actions_created ON actions(created_at);")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_actions_send_at ON actions(send_at) WHERE status='scheduled';"
+        )
+        await db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_actions_idem ON actions(idempotency_key) "
+            "WHERE idempotency_key IS NOT NULL;"
+        )
         await db.commit()
 
     async with db_connect() as db:
@@ -274,77 +618,284 @@ async def db_init():
         await db.commit()
 
 
-async def db_get_admin(user_id: int) -> Optional[dict]:
+@traced_db
+async def db_admin_ids() -> set:
+    async with db_connect() as db:
+        cur = await db.execute("SELECT user_id FROM admins")
+        return {int(r[0]) for r in await cur.fetchall()}
+
+
+def _admin_row(r) -> dict:
+    return {
+        "user_id": r[0],
+        "role": r[1],
+        "lang": r[2],
+        "target": r[3] or "me",
+        "comment": r[4],
+        "selected_gift_id": r[5],
+        "hide_name": int(r[6] or 0),
+    }
+
+
+async def _db_read_admin(user_id: int) -> Optional[dict]:
     async with db_connect() as db:
         cur = await db.execute(
             "SELECT user_id, role, lang, target, comment, selected_gift_id, hide_name FROM admins WHERE user_id=?",
             (user_id,)
         )
         r = await cur.fetchone()
-        if not r:
-            return None
-        return {
-            "user_id": r[0],
-            "role": r[1],
-            "lang": r[2],
-            "target": r[3] or "me",
-            "comment": r[4],
-            "selected_gift_id": r[5],
-            "hide_name": int(r[6] or 0),
-        }
+        return _admin_row(r) if r else None
+
+
+class SettingsWriteBehind:
+    """
+    Admin menu settings (target/comment/selected gift/hide_name) are applied to
+    memory right away and written to SQLite in one transaction per
+    SETTINGS_FLUSH_INTERVAL, instead of one commit per tap. Reads of a user
+    with unflushed changes see them through `overlay`.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending: Dict[int, dict] = {}   # user_id -> {column: value}
+        self._flips: Dict[int, int] = {}      # user_id -> hide_name toggles, mod 2
+        self._inflight: set[int] = set()      # users whose changes are being committed
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="settings-flush")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def set(self, user_id: int, column: str, value):
+        self._pending.setdefault(user_id, {})[column] = value
+        self._wake.set()
+
+    def toggle_hide_name(self, user_id: int):
+        self._flips[user_id] = self._flips.get(user_id, 0) ^ 1
+        self._wake.set()
+
+    def dirty(self, user_id: int) -> bool:
+        return user_id in self._pending or user_id in self._flips or user_id in self._inflight
+
+    async def read(self, user_id: int) -> Optional[dict]:
+        if not self.dirty(user_id):
+            return await _db_read_admin(user_id)
+        # flush bilan bir vaqtda o'qimaymiz: aks holda toggle ikki marta hisoblanadi
+        async with self._flush_lock:
+            row = await _db_read_admin(user_id)
+            return self.overlay(row) if row else None
+
+    def overlay(self, row: dict) -> dict:
+        uid = row["user_id"]
+        row = {**row, **self._pending.get(uid, {})}
+        if row.get("target") is None:
+            row["target"] = "me"
+        if self._flips.get(uid):
+            row["hide_name"] = 1 - row["hide_name"]
+        return row
+
+    async def flush(self):
+        async with self._flush_lock:
+            pending, flips = self._pending, {u: f for u, f in self._flips.items() if f}
+            self._pending, self._flips = {}, {}
+            if not pending and not flips:
+                return
+            self._inflight = set(pending) | set(flips)
+            try:
+                async with db_connect() as db:
+                    for col in ("target", "comment", "selected_gift_id"):
+                        rows = [(v[col], uid) for uid, v in pending.items() if col in v]
+                        if rows:
+                            await db.executemany(f"UPDATE admins SET {col}=? WHERE user_id=?", rows)
+                    if flips:
+                        await db.executemany(
+                            "UPDATE admins SET hide_name = 1 - hide_name WHERE user_id=?",
+                            [(uid,) for uid in flips]
+                        )
+                    await db.commit()
+            except BaseException:
+                # keep the batch for the next round; newer values win
+                for uid, v in pending.items():
+                    self._pending[uid] = {**v, **self._pending.get(uid, {})}
+                for uid, f in flips.items():
+                    self._flips[uid] = self._flips.get(uid, 0) ^ f
+                self._wake.set()
+                raise
+            finally:
+                self._inflight = set()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.interval)  # let more taps join this commit
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Settings flush failed, will retry")
+
+
+settings_wb = SettingsWriteBehind(SETTINGS_FLUSH_INTERVAL)
 
 
+@traced_db
+async def db_get_admin(user_id: int) -> Optional[dict]:
+    return await settings_wb.read(user_id)
+
+
+@traced_db
 async def db_set_target(user_id: int, target: str):
-    async with db_connect() as db:
-        await db.execute("UPDATE admins SET target=? WHERE user_id=?", (target, user_id))
-        await db.commit()
+    settings_wb.set(user_id, "target", target)
 
 
+@traced_db
 async def db_set_comment(user_id: int, comment: Optional[str]):
-    async with db_connect() as db:
-        await db.execute("UPDATE admins SET comment=? WHERE user_id=?", (comment, user_id))
-        await db.commit()
+    settings_wb.set(user_id, "comment", comment)
 
 
+@traced_db
 async def db_set_selected_gift(user_id: int, gift_id: Optional[int]):
-    async with db_connect() as db:
-        await db.execute("UPDATE admins SET selected_gift_id=? WHERE user_id=?", (gift_id, user_id))
-        await db.commit()
+    settings_wb.set(user_id, "selected_gift_id", gift_id)
 
 
+@traced_db
 async def db_toggle_hide_name(user_id: int) -> int:
-    async with db_connect() as db:
-        cur = await db.execute("SELECT hide_name FROM admins WHERE user_id=?", (user_id,))
-        r = await cur.fetchone()
-        cur_val = int((r[0] if r else 0) or 0)
-        new_val = 0 if cur_val == 1 else 1
-        await db.execute("UPDATE admins SET hide_name=? WHERE user_id=?", (new_val, user_id))
-        await db.commit()
-        return new_val
+    # DB'da bitta atomik UPDATE ... SET hide_name = 1 - hide_name (flush paytida)
+    settings_wb.toggle_hide_name(user_id)
+    a = await db_get_admin(user_id)
+    return a["hide_name"] if a else 0
 
 
+@traced_db
 async def db_create_action(
     creator_id: int,
     chat_id: Optional[int],
     target: str,
     gift: GiftItem,
     comment: Optional[str],
-    hide_name: int
+    hide_name: int,
+    send_at: Optional[int] = None,
+    bot_id: Optional[int] = None,
 ) -> int:
     now = int(time.time())
+    status = "scheduled" if send_at else "pending"
     async with db_connect() as db:
         cur = await db.execute("""
-            INSERT INTO actions(creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, created_at, updated_at)
-            VALUES(?,?,?,?,?,?,?,?,?,?)
-        """, (creator_id, chat_id, target, gift.id, gift.stars, comment, hide_name, "pending", now, now))
+            INSERT INTO actions(creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, send_at,
+                                bot_id, created_at, updated_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (creator_id, chat_id, target, gift.id, gift.stars, comment, hide_name, status, send_at,
+              bot_id, now, now))
         await db.commit()
-        return int(cur.lastrowid)
+    action_id = int(cur.lastrowid)
+    _note_created([action_id])
+    events.publish(action_id, status, creator_id=creator_id, gift_id=gift.id, stars=gift.stars,
+                   send_at=send_at, bot_id=bot_id)
+    return action_id
+
+
+@traced_db
+async def db_create_actions(
+    creator_id: int,
+    chat_id: Optional[int],
+    target: str,
+    gifts: List[GiftItem],
+    comment: Optional[str],
+    hide_name: int,
+    bot_id: Optional[int] = None,
+) -> List[int]:
+    # inline: bitta tranzaksiya, bitta commit
+    now = int(time.time())
+    ids: List[int] = []
+    async with db_connect() as db:
+        for gift in gifts:
+            cur = await db.execute("""
+                INSERT INTO actions(creator_id, chat_id, target, gift_id, stars, comment, hide_name, status,
+                                    bot_id, created_at, updated_at)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?)
+            """, (creator_id, chat_id, target, gift.id, gift.stars, comment, hide_name, "pending",
+                  bot_id, now, now))
+            ids.append(int(cur.lastrowid))
+        await db.commit()
+    _note_created(ids)
+    for action_id, gift in zip(ids, gifts):
+        events.publish(action_id, "pending", creator_id=creator_id, gift_id=gift.id, stars=gift.stars,
+                       bot_id=bot_id)
+    return ids
+
+
+@traced_db
+async def db_ingest_actions(creator_id: int, items: List[dict]) -> List[dict]:
+    """
+    HTTP API batch: all rows in one IMMEDIATE transaction, as status='scheduled'.
+    A known idempotency_key returns the existing action instead of a new one.
+    """
+    now = int(time.time())
+    out: List[dict] = []
+    created: List[Tuple[int, dict]] = []
+    async with db_connect() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        keys = list({it["key"] for it in items})
+        known: Dict[str, Tuple[int, str]] = {}
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            cur = await db.execute(
+                f"SELECT idempotency_key, action_id, status FROM actions "
+                f"WHERE idempotency_key IN ({','.join('?' * len(part))})", part
+            )
+            known.update({r[0]: (int(r[1]), r[2]) for r in await cur.fetchall()})
+        for it in items:
+            if it["key"] in known:
+                action_id, status = known[it["key"]]
+                out.append({"action_id": action_id, "status": status, "duplicate": True})
+                continue
+            gift = it["gift"]
+            send_at = it["send_at"] or now
+            cur = await db.execute("""
+                INSERT INTO actions(creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, send_at,
+                                    idempotency_key, created_at, updated_at)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+            """, (creator_id, None, it["target"], gift.id, gift.stars, it["comment"], it["hide_name"], "scheduled",
+                  send_at, it["key"], now, now))
+            action_id = int(cur.lastrowid)
+            known[it["key"]] = (action_id, "scheduled")
+            created.append((action_id, it))
+            out.append({"action_id": action_id, "status": "scheduled", "duplicate": False, "send_at": send_at})
+        await db.commit()
+    for action_id, it in created:
+        events.publish(action_id, "scheduled", creator_id=creator_id, gift_id=it["gift"].id,
+                       stars=it["gift"].stars, send_at=it["send_at"] or now, bot_id=None)
+    return out
+
+
+@traced_db
+async def db_action_statuses(creator_id: int, ids: List[int]) -> Dict[int, dict]:
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT action_id, status, error, send_at FROM actions "
+            f"WHERE creator_id=? AND action_id IN ({','.join('?' * len(ids))})",
+            (creator_id, *ids)
+        )
+        return {int(r[0]): {"action_id": int(r[0]), "status": r[1], "error": r[2], "send_at": r[3]}
+                for r in await cur.fetchall()}
 
 
+@traced_db
 async def db_get_action(action_id: int) -> Optional[dict]:
     async with db_connect() as db:
         cur = await db.execute("""
-            SELECT action_id, creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, error
+            SELECT action_id, creator_id, chat_id, target, gift_id, stars, comment, hide_name, status, error, send_at,
+                   bot_id
             FROM actions WHERE action_id=?
         """, (action_id,))
         r = await cur.fetchone()
@@ -361,40 +912,210 @@ async def db_get_action(action_id: int) -> Optional[dict]:
             "hide_name": int(r[7] or 0),
             "status": r[8],
             "error": r[9],
+            "send_at": r[10],
+            "bot_id": r[11],
         }
 
 
-async def db_try_lock_sending(action_id: int) -> Tuple[bool, str]:
+@traced_db
+async def db_try_lock_sending(action_id: int, from_status: str = "pending") -> Tuple[bool, str]:
+    # bitta shartli UPDATE: ikki parallel bosishdan faqat bittasi rowcount=1 oladi
     now = int(time.time())
     async with db_connect() as db:
-        cur = await db.execute("SELECT status FROM actions WHERE action_id=?", (action_id,))
-        row = await cur.fetchone()
-        if not row:
-            return False, "missing"
-        status = row[0]
-        if status == "sending":
-            return False, "sending"
-        if status != "pending":
-            return False, status
-
-        await db.execute("""
-            UPDATE actions SET status='sending', updated_at=? 
-            WHERE action_id=? AND status='pending'
-        """, (now, action_id))
+        cur = await db.execute("""
+            UPDATE actions SET status='sending', locked_by=?, updated_at=?
+            WHERE action_id=? AND status=?
+        """, (INSTANCE_ID, now, action_id, from_status))
         await db.commit()
+        if cur.rowcount == 1:
+            events.publish(action_id, "sending")
+            return True, "sending"
 
         cur2 = await db.execute("SELECT status FROM actions WHERE action_id=?", (action_id,))
-        row2 = await cur2.fetchone()
-        new_status = row2[0] if row2 else "missing"
-        return (new_status == "sending"), new_status
+        row = await cur2.fetchone()
+        return False, (row[0] if row else "missing")
 
 
+@traced_db
 async def db_mark_action(action_id: int, status: str, error: Optional[str] = None):
     now = int(time.time())
     async with db_connect() as db:
         await db.execute("UPDATE actions SET status=?, error=?, updated_at=? WHERE action_id=?",
                          (status, error, now, action_id))
         await db.commit()
+    events.publish(action_id, status, error=error)
+
+
+@traced_db
+async def db_attempt_begin_charge(action_id: int, attempt: int) -> int:
+    # SendStarsFormRequest dan OLDIN commit qilinadi: crash bo'lsa ham iz qoladi
+    now = int(time.time())
+    async with db_connect() as db:
+        cur = await db.execute("""
+            INSERT INTO action_attempts(action_id, attempt, step, outcome, created_at, updated_at)
+            VALUES(?,?,?,?,?,?)
+        """, (action_id, attempt, "charge", "started", now, now))
+        await db.commit()
+        return int(cur.lastrowid)
+
+
+@traced_db
+async def db_attempt_finish(
+    row_id: Optional[int],
+    action_id: int,
+    attempt: int,
+    step: str,
+    outcome: str,
+    error: Optional[str] = None,
+):
+    now = int(time.time())
+    async with db_connect() as db:
+        if row_id:
+            await db.execute(
+                "UPDATE action_attempts SET step=?, outcome=?, error=?, updated_at=? WHERE id=?",
+                (step, outcome, error, now, row_id)
+            )
+        else:
+            await db.execute("""
+                INSERT INTO action_attempts(action_id, attempt, step, outcome, error, created_at, updated_at)
+                VALUES(?,?,?,?,?,?,?)
+            """, (action_id, attempt, step, outcome, error, now, now))
+        await db.commit()
+
+
+async def _charge_state(db: aiosqlite.Connection, action_id: int) -> Optional[str]:
+    cur = await db.execute(
+        "SELECT outcome FROM action_attempts WHERE action_id=? AND step='charge' "
+        "AND outcome IN ('started', 'ok', 'unknown')",
+        (action_id,)
+    )
+    outcomes = {r[0] for r in await cur.fetchall()}
+    if not outcomes:
+        return None
+    return "ok" if "ok" in outcomes else "unknown"
+
+
+@traced_db
+async def db_charge_state(action_id: int) -> Optional[str]:
+    """'ok' / 'unknown' if any attempt may already have paid for this action, else None."""
+    async with db_connect() as db:
+        return await _charge_state(db, action_id)
+
+
+@traced_db
+async def db_cancel_action(action_id: int) -> bool:
+    # scheduler bilan poyga bo'lmasin: faqat hali yuborilmaganini bekor qilamiz
+    now = int(time.time())
+    async with db_connect() as db:
+        cur = await db.execute(
+            "UPDATE actions SET status='cancelled', error=NULL, updated_at=? "
+            "WHERE action_id=? AND status IN ('pending', 'scheduled')",
+            (now, action_id)
+        )
+        await db.commit()
+    if cur.rowcount != 1:
+        return False
+    events.publish(action_id, "cancelled")
+    return True
+
+
+@traced_db
+async def db_heartbeat(alive_since: int) -> set:
+    """Refreshes this instance's lease; returns the ids of the other live instances."""
+    now = int(time.time())
+    async with db_connect() as db:
+        await db.execute("""
+            INSERT INTO instances(instance_id, started_at, heartbeat_at) VALUES(?,?,?)
+            ON CONFLICT(instance_id) DO UPDATE SET heartbeat_at=excluded.heartbeat_at
+        """, (INSTANCE_ID, now, now))
+        await db.execute("DELETE FROM instances WHERE heartbeat_at < ?", (alive_since - 3600,))
+        await db.commit()
+        cur = await db.execute(
+            "SELECT instance_id FROM instances WHERE heartbeat_at >= ? AND instance_id != ?",
+            (alive_since, INSTANCE_ID)
+        )
+        return {r[0] for r in await cur.fetchall()}
+
+
+@traced_db
+async def db_drop_instance():
+    async with db_connect() as db:
+        await db.execute("DELETE FROM instances WHERE instance_id=?", (INSTANCE_ID,))
+        await db.commit()
+
+
+async def _orphan_rows(db: aiosqlite.Connection, alive_since: int) -> List[tuple]:
+    # locked_by IS NULL: rows locked before leases existed
+    cur = await db.execute("""
+        SELECT action_id, locked_by, send_at FROM actions
+        WHERE status='sending' AND (
+            (locked_by IS NULL AND updated_at < ?)
+            OR locked_by NOT IN (SELECT instance_id FROM instances WHERE heartbeat_at >= ?)
+        )
+    """, (alive_since, alive_since))
+    return await cur.fetchall()
+
+
+@traced_db
+async def db_recover_orphans(alive_since: int) -> List[Tuple[int, str, Optional[int]]]:
+    """
+    Settles 'sending' rows whose instance is gone, by the attempt log:
+    paid -> sent, maybe paid -> failed (never resent), not paid -> scheduled for now.
+    Returns (action_id, new_status, send_at).
+    """
+    now = int(time.time())
+    out = []
+    async with db_connect() as db:
+        for action_id, locked_by, send_at in await _orphan_rows(db, alive_since):
+            charge = await _charge_state(db, action_id)
+            if charge == "ok":
+                status, error = "sent", None
+            elif charge == "unknown":
+                status, error = "failed", "Interrupted during payment; check relayer Stars history before resending"
+            else:
+                status, error, send_at = "scheduled", None, send_at or now
+            upd = await db.execute("""
+                UPDATE actions SET status=?, error=?, send_at=?, locked_by=NULL, updated_at=?
+                WHERE action_id=? AND status='sending' AND locked_by IS ?
+            """, (status, error, send_at, now, action_id, locked_by))
+            if upd.rowcount == 1:
+                out.append((action_id, status, send_at))
+        await db.commit()
+    for action_id, status, send_at in out:
+        events.publish(action_id, status, send_at=send_at, recovered=True)
+    return out
+
+
+EXPORT_COLUMNS = (
+    "action_id", "bot_id", "creator_id", "chat_id", "target", "gift_id", "stars", "comment", "hide_name",
+    "status", "error", "send_at", "created_at", "updated_at",
+)
+
+
+async def db_iter_actions(ts_from: int, ts_to: int, chunk: int) -> AsyncIterator[List[tuple]]:
+    """Yields [ts_from, ts_to) actions in created_at order, `chunk` rows at a time, off one cursor."""
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT {', '.join(EXPORT_COLUMNS)} FROM actions INDEXED BY idx_actions_created "
+            "WHERE created_at >= ? AND created_at < ? ORDER BY created_at, action_id",
+            (ts_from, ts_to)
+        )
+        while True:
+            rows = await cur.fetchmany(chunk)
+            if not rows:
+                break
+            yield rows
+
+
+@traced_db
+async def db_next_scheduled(limit: int) -> List[Tuple[int, int]]:
+    # idx_actions_send_at bo'yicha: faqat eng yaqin `limit` ta
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT send_at, action_id FROM actions WHERE status='scheduled' ORDER BY send_at LIMIT ?",
+            (limit,)
+        )
+        return [(int(r[0]), int(r[1])) for r in await cur.fetchall()]
 
 
 # =========================
@@ -430,6 +1151,42 @@ def fmt_mode(lang: str, hide_name: int) -> str:
     return tr(lang, "mode_hide") if hide_name == 1 else tr(lang, "mode_show")
 
 
+_REL_TIME_RE = re.compile(r"\+(\d+)([mhd])")
+_REL_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+
+def parse_send_at(expr: str) -> Optional[int]:
+    """
+    `at` dan keyingi vaqt: HH:MM | YYYY-MM-DD HH:MM | YYYY-MM-DD | +30m/+2h/+1d.
+    BOT_TZ bo'yicha o'qiladi. Tanib bo'lmasa None.
+    """
+    s = (expr or "").strip()
+    now = datetime.now(BOT_TZ)
+
+    m = _REL_TIME_RE.fullmatch(s)
+    if m:
+        return int(now.timestamp()) + int(m.group(1)) * _REL_UNITS[m.group(2)]
+
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return int(datetime.strptime(s, fmt).replace(tzinfo=BOT_TZ).timestamp())
+        except ValueError:
+            pass
+
+    try:
+        hm = datetime.strptime(s, "%H:%M")
+    except ValueError:
+        return None
+    dt = now.replace(hour=hm.hour, minute=hm.minute, second=0, microsecond=0)
+    if dt <= now:
+        dt += timedelta(days=1)
+    return int(dt.timestamp())
+
+
+def fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, BOT_TZ).strftime("%Y-%m-%d %H:%M %Z")
+
+
 def parse_inline_query(q: str) -> Tuple[Optional[int], Optional[str], Optional[str]]:
     q = (q or "").strip()
     if not q:
@@ -464,9 +1221,78 @@ def _telethon_chat_id(chat_id: int) -> int:
     return chat_id
 
 
+class InstrumentedLock:
+    """asyncio.Lock that records how often and how long callers had to wait."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.waiting = 0
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.recent_waits: deque = deque(maxlen=10000)  # (monotonic ts, wait s), contended only
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def acquire(self) -> bool:
+        if not self._lock.locked() and not self.waiting:
+            await self._lock.acquire()
+            self.acquired += 1
+            return True
+        self.waiting += 1
+        t0 = time.monotonic()
+        try:
+            await self._lock.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - t0
+        self.acquired += 1
+        self.contended += 1
+        self.wait_total += waited
+        self.recent_waits.append((t0, waited))
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def snapshot(self) -> dict:
+        return {"acquired": self.acquired, "contended": self.contended, "wait_total": self.wait_total}
+
+
+class _RelayerClient(TelegramClient):
+    """
+    TelegramClient that reports its own auto-reconnects. Telethon reconnects
+    between keepalive pings without the client ever looking disconnected, and
+    calls _handle_auto_reconnect after each success.
+    """
+
+    on_reconnect: Optional[Callable[[], None]] = None
+
+    async def _handle_auto_reconnect(self):
+        if self.on_reconnect:
+            self.on_reconnect()
+        await super()._handle_auto_reconnect()
+
+
 class Relayer:
     def __init__(self):
-        self.client = TelegramClient(
+        self.client: Optional[_RelayerClient] = None  # built in start(): the export CLI has no relayer secrets
+        self._lock = InstrumentedLock()
+        # dc_id -> rtt/ping/reconnect counters. Only the home DC (session.dc_id) is used:
+        # sends, payments and pings all go there, so a migration shows up as a new key.
+        self.dc_stats: Dict[int, dict] = {}
+        self._last_ok = 0.0
+        self._keepalive_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.client = _RelayerClient(
             StringSession(RELAYER_SESSION),
             TG_API_ID,
             TG_API_HASH,
@@ -474,17 +1300,111 @@ class Relayer:
             connection_retries=5,
             retry_delay=2,
             auto_reconnect=True,
+            flood_sleep_threshold=0,  # FloodWait is handled by retry_send, not slept on silently
         )
-        self._lock = asyncio.Lock()
-
-    async def start(self):
+        self.client.on_reconnect = self._on_reconnect
         await self.client.connect()
         if not await self.client.is_user_authorized():
             raise RuntimeError("RELAYER_SESSION invalid. QR bilan qayta session oling.")
-        return await self.client.get_me()
+        me = await self.client.get_me()
+        try:
+            await self.ping()
+            await self.warm_payments()
+        except Exception:
+            log.exception("Relayer warm-up failed")
+        self._keepalive_task = asyncio.create_task(self._keepalive(), name="relayer-keepalive")
+        return me
 
     async def stop(self):
-        await self.client.disconnect()
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+        if self.client:
+            await self.client.disconnect()
+
+    def _dc(self) -> dict:
+        dc_id = self.client.session.dc_id
+        st = self.dc_stats.get(dc_id)
+        if st is None:
+            st = self.dc_stats[dc_id] = {
+                "rtt_ms": None, "rtt_avg_ms": None, "payments_rtt_ms": None,
+                "pings": 0, "failures": 0, "reconnects": 0,
+            }
+        return st
+
+    def _on_reconnect(self):
+        self._dc()["reconnects"] += 1
+        log.info("Relayer auto-reconnected (dc %s)", self.client.session.dc_id)
+
+    async def ping(self) -> float:
+        """One MTProto ping on the home DC (reconnecting first if needed). Returns RTT in ms."""
+        st = self._dc()
+        if not self.client.is_connected():
+            # auto_reconnect gave up (or never ran); this full reconnect counts too
+            st["reconnects"] += 1
+            log.warning("Relayer disconnected, reconnecting (dc %s)", self.client.session.dc_id)
+            await self.client.connect()
+            st = self._dc()
+        t0 = time.perf_counter()
+        try:
+            await self.client(functions.PingRequest(ping_id=random.getrandbits(63)))
+        except Exception:
+            st["failures"] += 1
+            raise
+        rtt = (time.perf_counter() - t0) * 1000
+        st["pings"] += 1
+        st["rtt_ms"] = round(rtt, 1)
+        st["rtt_avg_ms"] = round(rtt if st["rtt_avg_ms"] is None else st["rtt_avg_ms"] * 0.8 + rtt * 0.2, 1)
+        self._last_ok = time.monotonic()
+        return rtt
+
+    async def warm_payments(self):
+        # payments RPC'lari uy DC'da ishlaydi: shu yo'lni ham issiq saqlaymiz
+        t0 = time.perf_counter()
+        await self.client(functions.payments.GetStarsStatusRequest(peer=types.InputPeerSelf()))
+        self._dc()["payments_rtt_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        self._last_ok = time.monotonic()
+
+    async def _keepalive(self):
+        n = 0
+        while True:
+            await asyncio.sleep(RELAYER_PING_INTERVAL)
+            n += 1
+            try:
+                await asyncio.wait_for(self.ping(), RELAYER_READY_TIMEOUT)
+                if RELAYER_WARM_EVERY and n % RELAYER_WARM_EVERY == 0:
+                    await asyncio.wait_for(self.warm_payments(), RELAYER_READY_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Relayer keepalive failed: %s", e)
+
+    def is_warm(self) -> bool:
+        return self.client.is_connected() and time.monotonic() - self._last_ok < RELAYER_PING_INTERVAL * 1.5
+
+    async def ensure_ready(self):
+        """Readiness check before a send: returns at once when warm, else reconnects/pings first."""
+        if self.is_warm():
+            return
+        with timed("relayer.ensure_ready"):
+            await asyncio.wait_for(self.ping(), RELAYER_READY_TIMEOUT)
+
+    def health(self) -> dict:
+        return {
+            "connected": self.client.is_connected(),
+            "warm": self.is_warm(),
+            "home_dc": self.client.session.dc_id,
+            "since_last_ok_s": round(time.monotonic() - self._last_ok, 1) if self._last_ok else None,
+            "dcs": self.dc_stats,
+        }
+
+    @asynccontextmanager
+    async def _locked(self):
+        with timed("relayer.lock_wait"):
+            await self._lock.acquire()
+        try:
+            yield
+        finally:
+            self._lock.release()
 
     @staticmethod
     def _clean_comment(s: Optional[str]) -> Optional[str]:
@@ -500,18 +1420,20 @@ class Relayer:
         Reply targetni 100% topish:
         Relayer account shu chatda bo‘lishi shart.
         """
-        async with self._lock:
+        async with self._locked():
             # try resolve chat entity
             try:
                 chat_entity = await self.client.get_input_entity(chat_id)
-            except Exception:
+            except (ValueError, TypeError):
                 chat_entity = await self.client.get_input_entity(_telethon_chat_id(chat_id))
 
-            msg = await self.client.get_messages(chat_entity, ids=msg_id)
+            with timed("relayer.reply_fetch"):
+                msg = await self.client.get_messages(chat_entity, ids=msg_id)
             if not msg:
                 raise RuntimeError("REPLY_MESSAGE_NOT_FOUND")
 
-            sender = await msg.get_sender()
+            with timed("relayer.reply_sender"):
+                sender = await msg.get_sender()
             if not sender:
                 raise RuntimeError("REPLY_SENDER_NOT_FOUND")
 
@@ -524,16 +1446,26 @@ class Relayer:
         gift: GiftItem,
         comment: Optional[str],
         hide_name: bool,
+        on_step: Optional[Callable[[str], Awaitable[None]]] = None,
     ) -> bool:
-        async with self._lock:
-            can = await self.client(functions.payments.CheckCanSendGiftRequest(gift_id=gift.id))
+        async def _step(name: str):
+            if on_step:
+                await on_step(name)
+
+        async with self._locked():
+            await _step("check")
+            with timed("relayer.check"):
+                can = await self.client(functions.payments.CheckCanSendGiftRequest(gift_id=gift.id))
             if isinstance(can, types.payments.CheckCanSendGiftResultFail):
                 reason = getattr(can.reason, "text", None) or str(can.reason)
                 raise RuntimeError(f"Can't send gift: {reason}")
 
+            await _step("resolve")
             try:
-                peer = await self.client.get_input_entity(target)
-            except Exception:
+                with timed("relayer.resolve"):
+                    peer = await self.client.get_input_entity(target)
+            except (ValueError, TypeError):
+                # faqat "topilmadi"; FloodWait/uzilish retry_send'ga o'zicha boradi
                 raise RuntimeError("Cannot resolve target. Use @username or receiver should message relayer once.")
 
             cleaned = self._clean_comment(comment)
@@ -552,8 +1484,12 @@ class Relayer:
                     message=message_obj,
                     **extra
                 )
-                form = await self.client(functions.payments.GetPaymentFormRequest(invoice=invoice))
-                await self.client(functions.payments.SendStarsFormRequest(form_id=form.form_id, invoice=invoice))
+                await _step("form")
+                with timed("relayer.form"):
+                    form = await self.client(functions.payments.GetPaymentFormRequest(invoice=invoice))
+                await _step("charge")
+                with timed("relayer.charge"):
+                    await self.client(functions.payments.SendStarsFormRequest(form_id=form.form_id, invoice=invoice))
 
             if msg_obj is None:
                 await _try_send(None)
@@ -570,30 +1506,191 @@ class Relayer:
 
 
 # =========================
-# Bot UI
+# Retry engine
 # =========================
-def menu_kb(lang: str, hide_name: int) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    kb.button(text=tr(lang, "btn_target"), callback_data="menu:target")
-    kb.button(text=tr(lang, "btn_comment"), callback_data="menu:comment")
-    kb.button(text=tr(lang, "btn_gift"), callback_data="menu:gift")
-    kb.button(text=f"{tr(lang, 'btn_mode')} · {fmt_mode(lang, hide_name)}", callback_data="menu:mode")
-    kb.adjust(2, 2)
-    return kb.as_markup()
+class ChargeUncertainError(RuntimeError):
+    """SendStarsFormRequest may have gone through; resending could pay twice."""
 
 
-def back_kb(lang: str) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    kb.button(text=tr(lang, "btn_back"), callback_data="menu:home")
-    return kb.as_markup()
+def classify_send_error(e: BaseException) -> Tuple[str, float]:
+    """-> (kind, wait): kind is flood|transient|fatal, wait is the flood-wait in seconds."""
+    if isinstance(e, (FloodWaitError, FloodPremiumWaitError)):
+        return "flood", float(e.seconds)
+    if isinstance(e, (ServerError, TimedOutError, RpcCallFailError)):
+        return "transient", 0.0
+    if isinstance(e, RPCError):
+        return "fatal", 0.0
+    if isinstance(e, (ConnectionError, asyncio.TimeoutError, OSError)):
+        return "transient", 0.0
+    return "fatal", 0.0
 
 
-def price_kb(lang: str) -> InlineKeyboardMarkup:
-    kb = InlineKeyboardBuilder()
-    for p in ALLOWED_PRICES:
-        kb.button(text=f"⭐ {p}", callback_data=f"price:{p}")
-    kb.button(text=tr(lang, "btn_back"), callback_data="menu:home")
-    kb.adjust(2, 2, 1)
+def _charge_outcome(e: BaseException) -> str:
+    # server javob bergan (4xx/420) => pul yechilmagan; uzilish/5xx => noma'lum
+    if isinstance(e, RPCError) and not isinstance(e, (ServerError, TimedOutError, RpcCallFailError)):
+        return "rejected"
+    return "unknown"
+
+
+def backoff_delay(attempt: int) -> float:
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    return delay * (0.5 + random.random() / 2)
+
+
+class SendAttempt:
+    """One try of an action; the row is written before the charge step so it survives a crash."""
+
+    def __init__(self, action_id: int, n: int):
+        self.action_id = action_id
+        self.n = n
+        self.step_name = "start"
+        self._row_id: Optional[int] = None
+
+    async def step(self, name: str):
+        if name == "charge" and self._row_id is None:
+            # insert xatosi oddiy 'error' bo'lib qolsin: SendStarsFormRequest hali chaqirilmagan
+            self._row_id = await db_attempt_begin_charge(self.action_id, self.n)
+        self.step_name = name
+
+    async def finish(self, outcome: str, error: Optional[str] = None):
+        await db_attempt_finish(self._row_id, self.action_id, self.n, self.step_name, outcome, error)
+
+
+async def retry_send(action_id: int, send: Callable[[SendAttempt], Awaitable[bool]]) -> bool:
+    """
+    Runs `send` until it succeeds, sleeping out FloodWaits and backing off on
+    transient errors. Refuses to start if an earlier attempt may have paid.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        state = await db_charge_state(action_id)
+        if state == "ok":
+            raise ChargeUncertainError("Already paid by an earlier attempt")
+        if state == "unknown":
+            raise ChargeUncertainError("Payment state unknown after an interrupted attempt; not resending")
+
+        att = SendAttempt(action_id, attempt)
+        try:
+            result = await send(att)
+        except Exception as e:
+            kind, wait = classify_send_error(e)
+            if att.step_name == "charge":
+                outcome = _charge_outcome(e)
+            else:
+                outcome = "error"
+            await att.finish(outcome, f"{type(e).__name__}: {e}")
+
+            if outcome == "unknown":
+                raise ChargeUncertainError(f"Payment state unknown: {e}") from e
+            if kind == "fatal" or attempt >= RETRY_MAX_ATTEMPTS:
+                raise
+            if kind == "flood":
+                if wait > RETRY_MAX_FLOOD_WAIT:
+                    raise
+                delay = wait
+            else:
+                delay = backoff_delay(attempt)
+            log.warning("Action %s attempt %s: %s (%s), retry in %.1fs", action_id, attempt, kind, e, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        await att.finish("ok")
+        return result
+
+
+# =========================
+# Send admission
+# =========================
+class SendAdmission:
+    """
+    Bounded line in front of the relayer. admit() counts a send in (or refuses it when
+    SEND_MAX_QUEUE sends are already in line or the estimated wait exceeds SEND_MAX_WAIT);
+    turn() runs one attempt at a time in FIFO order and measures how long it took.
+    The wait estimate is sends-in-line x EWMA of attempt durations.
+    """
+
+    def __init__(self, max_queue: int, max_wait: float, initial: float, alpha: float = 0.2):
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self.ewma = initial
+        self.depth = 0  # admitted and not finished: waiting for a turn, sending or backing off
+        self.admitted = 0
+        self.shed = 0
+        # sends queue here before relayer._lock is ever contended; /profile reports both
+        self._turn = InstrumentedLock()
+
+    def estimate(self) -> float:
+        """Seconds a send admitted now would wait before its turn."""
+        return self.depth * self.ewma
+
+    def admit(self, shed: bool = True) -> bool:
+        # scheduler/API sends are never shed: they were accepted earlier and just count in line
+        if shed and (self.depth >= self.max_queue or self.estimate() > self.max_wait):
+            self.shed += 1
+            return False
+        self.depth += 1
+        self.admitted += 1
+        return True
+
+    def leave(self):
+        self.depth -= 1
+
+    def retry_in(self) -> int:
+        fits = min(self.max_queue - 1, int(self.max_wait / self.ewma)) if self.ewma > 0 else self.max_queue - 1
+        return max(1, math.ceil((self.depth - fits) * self.ewma))
+
+    @asynccontextmanager
+    async def turn(self):
+        async with self._turn:
+            t0 = time.monotonic()
+            try:
+                yield
+            finally:
+                self.ewma += self.alpha * ((time.monotonic() - t0) - self.ewma)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "running": self._turn.locked(),
+            "est_wait_s": round(self.estimate(), 2),
+            "ewma_send_s": round(self.ewma, 3),
+            "max_queue": self.max_queue,
+            "max_wait_s": self.max_wait,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+
+send_admission = SendAdmission(SEND_MAX_QUEUE, SEND_MAX_WAIT, SEND_EST_INIT)
+
+
+# =========================
+# Bot UI
+# =========================
+def menu_kb(lang: str, hide_name: int) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text=tr(lang, "btn_target"), callback_data="menu:target")
+    kb.button(text=tr(lang, "btn_comment"), callback_data="menu:comment")
+    kb.button(text=tr(lang, "btn_gift"), callback_data="menu:gift")
+    kb.button(text=f"{tr(lang, 'btn_mode')} · {fmt_mode(lang, hide_name)}", callback_data="menu:mode")
+    kb.adjust(2, 2)
+    return kb.as_markup()
+
+
+def back_kb(lang: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text=tr(lang, "btn_back"), callback_data="menu:home")
+    return kb.as_markup()
+
+
+def price_kb(lang: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for p in ALLOWED_PRICES:
+        kb.button(text=f"⭐ {p}", callback_data=f"price:{p}")
+    kb.button(text=tr(lang, "btn_back"), callback_data="menu:home")
+    kb.adjust(2, 2, 1)
     return kb.as_markup()
 
 
@@ -614,26 +1711,162 @@ def action_kb(lang: str, action_id: int) -> InlineKeyboardMarkup:
     return kb.as_markup()
 
 
-async def safe_edit(c: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup]):
-    try:
-        if c.message:
-            await c.message.edit_text(text, reply_markup=reply_markup)
-            if reply_markup is None:
-                try:
-                    await c.message.edit_reply_markup(reply_markup=None)
-                except Exception:
-                    pass
-        else:
-            await bot.edit_message_text(inline_message_id=c.inline_message_id, text=text, reply_markup=reply_markup)
-            if reply_markup is None:
-                try:
-                    await bot.edit_message_reply_markup(inline_message_id=c.inline_message_id, reply_markup=None)
-                except Exception:
-                    pass
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
+def cancel_kb(lang: str, action_id: int) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text=tr(lang, "btn_cancel"), callback_data=f"act:cancel:{action_id}")
+    return kb.as_markup()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, wanted: Callable[[], bool] = lambda: True) -> bool:
+        """Waits for a token; gives up (False) as soon as `wanted()` turns false."""
+        while wanted():
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            await asyncio.sleep(min(0.5, (1 - self.tokens) / self.rate))
+        return False
+
+    def pause(self, seconds: float):
+        # 429 retry_after: nobody gets a token until it passes
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class EditOutbox:
+    """
+    All message edits go through here. Remembers what each message currently
+    shows and skips edits that would not change it, lets a newer edit of the
+    same message replace one still waiting for a token, and paces requests
+    under per-chat and global token buckets.
+    """
+
+    def __init__(self):
+        self._global: Dict[int, TokenBucket] = {}  # Bot API limits are per bot token
+        self._chats: Dict[object, TokenBucket] = {}
+        # key -> [shown render hash, version, newest requested render hash]
+        self._state: "OrderedDict[object, list]" = OrderedDict()
+        self.stats = {"sent": 0, "skipped": 0, "superseded": 0, "retry_after": 0}
+
+    def _bucket(self, chat_key: object, private: bool) -> TokenBucket:
+        b = self._chats.get(chat_key)
+        if b is None:
+            if len(self._chats) > EDIT_CACHE_SIZE:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            if private:
+                b = TokenBucket(EDIT_PRIVATE_RATE, 3)
+            else:
+                b = TokenBucket(EDIT_GROUP_RATE, 5)
+            self._chats[chat_key] = b
+        return b
+
+    def _remember(self, key: object, h: int):
+        st = self._state.get(key)
+        if st:
+            st[0] = h
+            self._state.move_to_end(key)
+
+    async def edit(
+        self,
+        bot_: Bot,
+        *,
+        text: str,
+        reply_markup: Optional[InlineKeyboardMarkup],
+        chat_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        inline_message_id: Optional[str] = None,
+        chat_key: Optional[object] = None,
+    ):
+        # private chat ids are the same for every bot, message ids are not
+        key = (bot_.id, inline_message_id or (chat_id, message_id))
+        h = hash((text, reply_markup.model_dump_json() if reply_markup else ""))
+
+        st = self._state.get(key)
+        # eng oxirgi so'ralgan render bilan solishtiramiz: kutayotgan edit bo'lsa, u yutmasligi kerak
+        if st and st[2] == h:
+            self.stats["skipped"] += 1
             return
-        raise
+        if st is None:
+            st = self._state[key] = [None, 0, None]
+            if len(self._state) > EDIT_CACHE_SIZE:
+                self._state.popitem(last=False)
+        st[1] += 1
+        st[2] = h
+        version = st[1]
+
+        # editMessageText without reply_markup drops the keyboard, so one call covers both
+        bucket = self._bucket((bot_.id, chat_key if chat_key is not None else chat_id), (chat_id or 0) > 0)
+        global_bucket = self._global.get(bot_.id)
+        if global_bucket is None:
+            global_bucket = self._global[bot_.id] = TokenBucket(EDIT_GLOBAL_RATE, EDIT_GLOBAL_RATE)
+        def current() -> bool:
+            return st[1] == version
+
+        for _ in range(EDIT_MAX_RETRIES + 1):
+            if not await bucket.acquire(current) or not await global_bucket.acquire(current):
+                self.stats["superseded"] += 1
+                return
+            try:
+                await bot_.edit_message_text(
+                    text=text,
+                    chat_id=None if inline_message_id else chat_id,
+                    message_id=None if inline_message_id else message_id,
+                    inline_message_id=inline_message_id,
+                    reply_markup=reply_markup,
+                )
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                log.warning("Edit 429 in %s, retry after %ss", chat_id or "inline", e.retry_after)
+                bucket.pause(e.retry_after)
+                continue
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._remember(key, h)
+                    return
+                if current():
+                    st[2] = st[0]
+                raise
+            self.stats["sent"] += 1
+            self._remember(key, h)
+            return
+        # edits are cosmetic: give up, and let the next request for this message try again
+        log.warning("Edit in %s dropped after %s rate limits", chat_id or "inline", EDIT_MAX_RETRIES + 1)
+        if current():
+            st[2] = st[0]
+
+
+edit_outbox = EditOutbox()
+
+
+async def safe_edit(c: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup]):
+    bot_ = c.bot or bot
+    if c.message:
+        await edit_outbox.edit(
+            bot_, text=text, reply_markup=reply_markup,
+            chat_id=c.message.chat.id, message_id=c.message.message_id,
+        )
+    else:
+        # inline message: chat unknown, pace it like a group under the clicking user
+        await edit_outbox.edit(
+            bot_, text=text, reply_markup=reply_markup,
+            inline_message_id=c.inline_message_id, chat_key=("inline", c.from_user.id),
+        )
 
 
 async def render_status(admin: dict) -> str:
@@ -662,10 +1895,222 @@ async def render_status(admin: dict) -> str:
 # =========================
 # App objects
 # =========================
-bot = Bot(BOT_TOKEN)
+bots: List[Bot] = [Bot(t) for t in BOT_TOKENS]
+bot: Optional[Bot] = bots[0] if bots else None  # primary; handlers use the bot the update came from
+BOTS_BY_ID: Dict[int, Bot] = {b.id: b for b in bots}
 dp = Dispatcher(storage=MemoryStorage())
 relayer = Relayer()
 
+
+class Drain:
+    """Counts in-flight updates and scheduled fires; `draining` stops new sends from starting."""
+
+    def __init__(self):
+        self.draining = False
+        self.active = 0
+        self.offsets: Dict[int, int] = {}  # bot_id -> highest update_id taken in
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextmanager
+    def track(self):
+        self.active += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+drain = Drain()
+
+
+@dp.update.outer_middleware()
+async def trace_middleware(handler, event: Update, data: dict):
+    # update_id is per bot, so the bot id is part of the trace
+    bot_id = data["bot"].id
+    drain.offsets[bot_id] = max(drain.offsets.get(bot_id, 0), event.update_id)
+    with trace(f"upd:{bot_id}:{event.update_id}"), drain.track():
+        return await handler(event, data)
+
+
+# =========================
+# Traffic recorder
+# =========================
+_ANON_NAME_FIELDS = ("username", "first_name", "last_name", "title")
+
+
+def anon_id(v: int) -> int:
+    """Stable (per RECORD_SALT) fake id that keeps the sign and the -100 supergroup prefix."""
+    h = int(hmac.new(RECORD_SALT.encode(), str(v).encode(), hashlib.sha256).hexdigest()[:15], 16)
+    if str(v).startswith("-100"):
+        return -(10 ** 12 + h % 10 ** 10)
+    if v < 0:
+        return -(1 + h % 10 ** 9)
+    return 1 + h % 10 ** 10
+
+
+_MENTION_RE = re.compile(r"(?<![/\w])@(\w+)")
+_ANON_TEXT_FIELDS = ("text", "query", "caption")
+
+
+def _anon_mention(m: "re.Match") -> str:
+    # bir xil uzunlik: entity offset/length'lar buzilmaydi
+    name = m.group(1)
+    h = hmac.new(RECORD_SALT.encode(), name.lower().encode(), hashlib.sha256).hexdigest()
+    return "@" + ("u" + h)[:len(name)]
+
+
+def anonymize(obj):
+    # User/Chat dict'larida id va ismlar, matn/query ichidagi @username'lar almashtiriladi;
+    # callback_data o'zgarmaydi
+    if isinstance(obj, list):
+        return [anonymize(x) for x in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {k: anonymize(v) for k, v in obj.items()}
+    for f in _ANON_TEXT_FIELDS:
+        if isinstance(out.get(f), str):
+            out[f] = _MENTION_RE.sub(_anon_mention, out[f])
+    if isinstance(out.get("id"), int) and ("is_bot" in out or "type" in out):
+        out["id"] = anon_id(out["id"])
+        for f in _ANON_NAME_FIELDS:
+            if out.get(f):
+                out[f] = f"{f}_{abs(out['id']) % 100000}"
+    return out
+
+
+def setup_recorder(path: str) -> logging.Logger:
+    # logging bilan bir xil: loop faqat navbatga qo'yadi, faylga alohida thread yozadi
+    fh = logging.FileHandler(path, encoding="utf-8")
+    fh.setFormatter(logging.Formatter("%(message)s"))
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, fh)
+    listener.start()
+    atexit.register(listener.stop)
+
+    rec = logging.getLogger("giftbot.recorder")
+    rec.propagate = False
+    rec.setLevel(logging.INFO)
+    rec.handlers[:] = [logging.handlers.QueueHandler(q)]
+    return rec
+
+
+if RECORD_UPDATES:
+    _recorder = setup_recorder(RECORD_UPDATES)
+    _record_t0 = time.monotonic()
+
+    @dp.update.outer_middleware()
+    async def record_middleware(handler, event: Update, data: dict):
+        line = {
+            "t": round(time.monotonic() - _record_t0, 4),
+            "bot": data["bot"].id,
+            "update": anonymize(event.model_dump(mode="json", exclude_none=True, by_alias=True)),
+        }
+        created: List[int] = []
+        token = created_ids_var.set(created)
+        try:
+            return await handler(event, data)
+        finally:
+            # written after the handler so replay can map recorded action ids to its own
+            created_ids_var.reset(token)
+            if created:
+                line["created"] = created
+            _recorder.info(json.dumps(line, ensure_ascii=False))
+
+
+# =========================
+# Admission filter
+# =========================
+class AdmissionFilter:
+    """
+    Admin ids in memory, reloaded every ADMIN_REFRESH seconds (and on first use).
+    Lets the outer middleware turn strangers away before any handler or DB call.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.ids: set[int] = {OWNER_ID}
+        self.loaded = False
+        self.dropped = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self):
+        self.ids = await db_admin_ids() | {OWNER_ID}
+        self.loaded = True
+
+    async def ensure_loaded(self):
+        async with self._lock:  # a burst of first updates loads once
+            if not self.loaded:
+                await self.refresh()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="admission-refresh")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception("Admin id refresh failed")
+
+
+admission = AdmissionFilter(ADMIN_REFRESH)
+
+
+async def _is_menu_command(text: Optional[str], bot_: Bot) -> bool:
+    if not text or not text.startswith("/"):
+        return False
+    cmd, _, mention = text.split()[0].partition("@")
+    if cmd.lower() not in ("/start", "/menu"):
+        return False
+    # Command() kabi: boshqa botga yozilgan /start@OtherBot ga javob bermaymiz
+    return not mention or mention.lower() == ((await bot_.me()).username or "").lower()
+
+
+@dp.update.outer_middleware()
+async def admission_middleware(handler, event: Update, data: dict):
+    # trace/recorder middleware'lardan keyin: drain offset'lari va yozuvlar hammasini ko'radi
+    if not admission.loaded:
+        await admission.ensure_loaded()
+    user = data.get("event_from_user")
+    if user and user.id in admission.ids:
+        return await handler(event, data)
+
+    # begona: DB'ga tegmasdan, avvalgidek javob (yoki jimlik)
+    admission.dropped += 1
+    if event.message and await _is_menu_command(event.message.text, data["bot"]):
+        await event.message.answer(tr(DEFAULT_LANG, "no_access"))
+    elif event.callback_query:
+        await event.callback_query.answer(tr(DEFAULT_LANG, "no_access"), show_alert=True)
+    elif event.inline_query:
+        q = event.inline_query
+        # keystrokes still coalesce: one empty answer per burst, not one per letter
+        if await inline_coalescer.claim(q.from_user.id):
+            inline_coalescer.release(q.from_user.id)
+            await q.answer([], is_personal=True, cache_time=INLINE_HELP_CACHE_TIME)
+    return None
+
+
 # SODDA: faqat bosilganda keyingi text qaysi maqsadga ketishini bilamiz
 WAITING_TARGET: set[int] = set()
 WAITING_COMMENT: set[int] = set()
@@ -707,7 +2152,21 @@ async def cmd_gift(m: Message):
     lang = a["lang"]
     parts = (m.text or "").split()
     if len(parts) < 2 or not parts[1].isdigit():
-        return await m.answer("Usage: /gift 50 [@username|id|me] [comment...]")
+        return await m.answer("Usage: /gift 50 [@username|id|me] [comment...] [at HH:MM|YYYY-MM-DD HH:MM|+2h]")
+
+    # 0) oxirida "at <vaqt>" bo'lsa — rejalashtirilgan sovg'a
+    send_at: Optional[int] = None
+    for i in range(len(parts) - 1, 1, -1):
+        if parts[i].lower() != "at":
+            continue
+        ts = parse_send_at(" ".join(parts[i + 1:]))
+        if ts is None:
+            break  # "at" is just part of the comment
+        if ts <= int(time.time()):
+            return await m.answer(tr(lang, "bad_time"))
+        send_at = ts
+        parts = parts[:i]
+        break
 
     max_stars = int(parts[1])
     target: Optional[str] = None
@@ -730,6 +2189,11 @@ async def cmd_gift(m: Message):
         else:
             return await m.answer(tr(lang, "reply_need"))
 
+    # rejalashtirilganda "me" ni hozir @username ga aylantiramiz: scheduler'da username yo'q,
+    # relayer esa ko'rmagan user'ni raqamli id bo'yicha topa olmaydi
+    if send_at and target == "me" and m.from_user.username:
+        target = f"@{m.from_user.username}"
+
     gifts = gifts_up_to(max_stars)
     if not gifts:
         return await m.answer("No gifts for that stars limit.")
@@ -742,6 +2206,8 @@ async def cmd_gift(m: Message):
         gift=gift,
         comment=comment,
         hide_name=a["hide_name"],
+        send_at=send_at,
+        bot_id=m.bot.id,
     )
 
     cm = comment if comment else "(no comment)"
@@ -750,9 +2216,178 @@ async def cmd_gift(m: Message):
         f"🎯 {('reply-target' if target.startswith('reply:') else target)}\n"
         f"🔒 {fmt_mode(lang, a['hide_name'])}\n"
         f"💬 {cm}\n\n"
-        f"{tr(lang, 'confirm_title')}"
     )
-    await m.answer(msg, reply_markup=action_kb(lang, act_id))
+    if send_at:
+        scheduler.notify(act_id, send_at)
+        return await m.answer(msg + tr(lang, "scheduled", at=fmt_ts(send_at)), reply_markup=cancel_kb(lang, act_id))
+    await m.answer(msg + tr(lang, "confirm_title"), reply_markup=action_kb(lang, act_id))
+
+
+# =========================
+# Owner diagnostics
+# =========================
+_profiling = False
+
+
+@dp.message(Command("profile"))
+async def cmd_profile(m: Message):
+    global _profiling
+    if m.from_user.id != OWNER_ID:
+        return
+
+    parts = (m.text or "").split()
+    secs = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+    secs = max(1, min(secs, PROFILE_MAX_SECONDS))
+    if _profiling:
+        return await m.answer("⏳ A profile is already running.")
+
+    _profiling = True
+    try:
+        await m.answer(f"⏱ Profiling for {secs}s...")
+        summary, path = await profile_loop(secs)
+    finally:
+        _profiling = False
+
+    await m.answer(f"📄 {path}\n{summary}"[:4000])
+
+
+def _lock_txt(lock: InstrumentedLock, s0: dict, t_start: float) -> str:
+    s1 = lock.snapshot()
+    contended = s1["contended"] - s0["contended"]
+    waited = s1["wait_total"] - s0["wait_total"]
+    window_waits = [w for t, w in lock.recent_waits if t >= t_start]
+    return (
+        f"{s1['acquired'] - s0['acquired']} acquired, {contended} contended, "
+        f"wait avg {(waited / contended * 1000) if contended else 0:.0f}ms / "
+        f"max {max(window_waits, default=0) * 1000:.0f}ms, waiting now {lock.waiting}"
+    )
+
+
+async def profile_loop(secs: int) -> Tuple[str, str]:
+    """cProfile the event loop thread for `secs`, sampling task counts and send turn / relayer lock waits."""
+    locks = {"send turn": send_admission._turn, "relayer lock": relayer._lock}
+    lock0 = {name: lock.snapshot() for name, lock in locks.items()}
+    t_start = time.monotonic()
+    task_counts: List[int] = []
+
+    async def _sample_tasks():
+        while True:
+            task_counts.append(len(asyncio.all_tasks()))
+            await asyncio.sleep(0.1)
+
+    prof = cProfile.Profile()
+    sampler = asyncio.create_task(_sample_tasks())
+    prof.enable()
+    try:
+        await asyncio.sleep(secs)
+    finally:
+        prof.disable()
+        sampler.cancel()
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), f"profile-{stamp}.pstats")
+    await asyncio.to_thread(prof.dump_stats, path)
+
+    buf = io.StringIO()
+    pstats.Stats(prof, stream=buf).strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    top = "\n".join(ln for ln in buf.getvalue().splitlines() if ln.strip())
+
+    tasks_txt = "-"
+    if task_counts:
+        tasks_txt = f"min {min(task_counts)} / avg {sum(task_counts) / len(task_counts):.1f} / max {max(task_counts)}"
+
+    rtt_txt = ", ".join(
+        f"dc{dc} {st['rtt_avg_ms']}ms ({st['reconnects']} reconnects)" for dc, st in relayer.dc_stats.items()
+    ) or "-"
+
+    locks_txt = "".join(f"{name}: {_lock_txt(lock, lock0[name], t_start)}\n" for name, lock in locks.items())
+
+    summary = (
+        f"🧪 Profile {secs}s\n"
+        f"tasks: {tasks_txt}\n"
+        f"{locks_txt}"
+        f"relayer rtt: {rtt_txt}\n"
+        f"send line: {send_admission.depth} in line, est wait {send_admission.estimate():.1f}s, "
+        f"{send_admission.shed} shed\n\n"
+        f"{top}"
+    )
+    return summary, path
+
+
+def _export_day(s: str) -> int:
+    return int(datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=BOT_TZ).timestamp())
+
+
+def export_range(date_from: Optional[str], date_to: Optional[str]) -> Tuple[int, int]:
+    """YYYY-MM-DD bounds in BOT_TZ, `to` inclusive. No args: the previous calendar month."""
+    if date_to and not date_from:
+        raise ValueError("'to' date needs a 'from' date")
+    if date_from:
+        ts_from = _export_day(date_from)
+        ts_to = _export_day(date_to) + 86400 if date_to else int(time.time()) + 1
+        return ts_from, ts_to
+    first = datetime.now(BOT_TZ).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    prev = (first - timedelta(days=1)).replace(day=1)
+    return int(prev.timestamp()), int(first.timestamp())
+
+
+def _encode_rows(rows: List[tuple], fmt: str, header: bool) -> bytes:
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, r)), ensure_ascii=False) + "\n" for r in rows
+        ).encode("utf-8")
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    if header:
+        w.writerow(EXPORT_COLUMNS)
+    w.writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+
+async def export_actions(path: str, ts_from: int, ts_to: int, fmt: str = "csv") -> int:
+    """Streams the ledger into a gzip file chunk by chunk; memory stays flat whatever the row count."""
+    n = 0
+    gz = await asyncio.to_thread(gzip.open, path, "wb", 6)
+    try:
+        if fmt == "csv":
+            await asyncio.to_thread(gz.write, _encode_rows([], fmt, header=True))
+        async for rows in db_iter_actions(ts_from, ts_to, EXPORT_CHUNK_ROWS):
+            await asyncio.to_thread(gz.write, _encode_rows(rows, fmt, header=False))
+            n += len(rows)
+    finally:
+        await asyncio.to_thread(gz.close)
+    return n
+
+
+@dp.message(Command("export"))
+async def cmd_export(m: Message):
+    if m.from_user.id != OWNER_ID:
+        return
+
+    args = (m.text or "").split()[1:]
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "ndjson"):
+        fmt = args.pop().lower()
+    try:
+        ts_from, ts_to = export_range(args[0] if args else None, args[1] if len(args) > 1 else None)
+    except ValueError:
+        return await m.answer("Usage: /export [YYYY-MM-DD] [YYYY-MM-DD] [csv|ndjson]")
+
+    name = f"actions_{fmt_ts(ts_from)[:10]}_{fmt_ts(ts_to - 1)[:10]}.{fmt}.gz"
+    fd, path = tempfile.mkstemp(suffix=".gz", dir=os.path.dirname(os.path.abspath(DB_PATH)))
+    os.close(fd)
+    keep = False
+    try:
+        with timed("export"):
+            n = await export_actions(path, ts_from, ts_to, fmt)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_UPLOAD:
+            keep = True
+            return await m.answer(f"📦 {n} rows, {size // 1024 // 1024} MB — too big for Telegram, saved: {path}")
+        await m.answer_document(FSInputFile(path, filename=name), caption=f"📦 {n} rows")
+    finally:
+        if not keep:
+            os.unlink(path)
 
 
 # =========================
@@ -881,17 +2516,55 @@ async def cb_gift(c: CallbackQuery):
 INLINE_LIMIT = 30
 
 
+class InlineCoalescer:
+    """
+    Keeps only the newest inline query per user. A new keystroke cancels the
+    previous handler task; after a short debounce only the latest one goes on.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._latest: Dict[int, asyncio.Task] = {}
+
+    async def claim(self, user_id: int) -> bool:
+        me = asyncio.current_task()
+        prev = self._latest.get(user_id)
+        self._latest[user_id] = me
+        if prev is not None and prev is not me and not prev.done():
+            prev.cancel()
+        if self.delay > 0:
+            await asyncio.sleep(self.delay)
+        return self._latest.get(user_id) is me
+
+    def release(self, user_id: int):
+        if self._latest.get(user_id) is asyncio.current_task():
+            del self._latest[user_id]
+
+
+inline_coalescer = InlineCoalescer(INLINE_DEBOUNCE)
+
+
 @dp.inline_query()
 async def inline_handler(q: InlineQuery):
+    uid = q.from_user.id
+    if not await inline_coalescer.claim(uid):
+        return  # superseded; Telegram drops the stale query on its side
+    try:
+        await _inline_answer(q)
+    finally:
+        inline_coalescer.release(uid)
+
+
+async def _inline_answer(q: InlineQuery):
     a = await db_get_admin(q.from_user.id)
     if not a:
-        return await q.answer([], is_personal=True, cache_time=1)
+        return await q.answer([], is_personal=True, cache_time=INLINE_HELP_CACHE_TIME)
 
     lang = a["lang"]
-    bot_me = await bot.get_me()
 
     max_stars, target, comment = parse_inline_query(q.query)
     if not max_stars or not target:
+        bot_me = await q.bot.me()
         help_res = InlineQueryResultArticle(
             id="help",
             title=tr(lang, "inline_help_title"),
@@ -899,20 +2572,21 @@ async def inline_handler(q: InlineQuery):
                 message_text=tr(lang, "inline_help_text", bot=bot_me.username)
             ),
         )
-        return await q.answer([help_res], is_personal=True, cache_time=1)
+        return await q.answer([help_res], is_personal=True, cache_time=INLINE_HELP_CACHE_TIME)
 
     gifts = gifts_up_to(max_stars)[:INLINE_LIMIT]
+    action_ids = await db_create_actions(
+        creator_id=q.from_user.id,
+        chat_id=None,
+        target=target,
+        gifts=gifts,
+        comment=comment,
+        hide_name=a["hide_name"],
+        bot_id=q.bot.id,
+    )
     results: List[InlineQueryResultArticle] = []
 
-    for g in gifts:
-        action_id = await db_create_action(
-            creator_id=q.from_user.id,
-            chat_id=None,
-            target=target,
-            gift=g,
-            comment=comment,
-            hide_name=a["hide_name"],
-        )
+    for g, action_id in zip(gifts, action_ids):
         cm = comment if comment else "(no comment)"
         msg = (
             f"🎁 {fmt_gift(g)}\n"
@@ -931,7 +2605,7 @@ async def inline_handler(q: InlineQuery):
             )
         )
 
-    await q.answer(results, is_personal=True, cache_time=1)
+    await q.answer(results, is_personal=True, cache_time=INLINE_CACHE_TIME)
 
 
 # =========================
@@ -944,10 +2618,10 @@ async def action_callback(c: CallbackQuery):
         return await c.answer(tr(DEFAULT_LANG, "no_access"), show_alert=True)
 
     lang = a["lang"]
-    await c.answer()
 
     _, cmd, sid = c.data.split(":", 2)
     action_id = int(sid)
+    trace_id_var.set(f"act:{action_id}")  # handler task'ning o'z konteksti
 
     act = await db_get_action(action_id)
     if not act:
@@ -956,104 +2630,677 @@ async def action_callback(c: CallbackQuery):
     if act["creator_id"] != c.from_user.id:
         return await c.answer(tr(lang, "creator_only"), show_alert=True)
 
+    if act["bot_id"] and act["bot_id"] != c.bot.id:
+        return await c.answer(tr(lang, "already_done"), show_alert=True)
+
     gift = GIFTS_BY_ID.get(act["gift_id"])
     if not gift:
         await db_mark_action(action_id, "failed", error="Gift not in catalog")
+        await c.answer()
         return await safe_edit(c, tr(lang, "err", e="Gift not found"), reply_markup=None)
 
+    # callback'ga bir marta javob beriladi: alert kerak bo'lsa, bo'sh answer() dan oldin
     if cmd == "cancel":
-        if act["status"] != "pending":
+        if not await db_cancel_action(action_id):
             return await c.answer(tr(lang, "already_done"), show_alert=True)
-        await db_mark_action(action_id, "cancelled", error=None)
+        await c.answer()
         return await safe_edit(c, f"{tr(lang, 'cancelled')} ✅\n\n🎁 {fmt_gift(gift)}", reply_markup=None)
 
     if cmd == "send":
-        ok, st = await db_try_lock_sending(action_id)
-        if not ok:
-            if st == "sending":
-                return await c.answer(tr(lang, "still_sending"), show_alert=False)
+        if drain.draining:
+            # pending qoladi: yangi instance'da qayta bosiladi
+            return await c.answer(tr(lang, "restarting"), show_alert=True)
+        # navbatdan oldin: allaqachon yuborilayotganiga "busy" emas, "still sending" ko'rinsin
+        if act["status"] == "sending":
+            return await c.answer(tr(lang, "still_sending"), show_alert=False)
+        if act["status"] != "pending":
             return await c.answer(tr(lang, "already_done"), show_alert=True)
+        if not send_admission.admit():
+            return await c.answer(tr(lang, "busy", s=send_admission.retry_in()), show_alert=True)
+        try:
+            return await _callback_send(c, lang, act, gift)
+        finally:
+            send_admission.leave()
+
+    await c.answer()
+
+
+async def _callback_send(c: CallbackQuery, lang: str, act: dict, gift: GiftItem):
+    action_id = act["action_id"]
+    ok, st = await db_try_lock_sending(action_id)
+    if not ok:
+        if st == "sending":
+            return await c.answer(tr(lang, "still_sending"), show_alert=False)
+        return await c.answer(tr(lang, "already_done"), show_alert=True)
+    await c.answer()
+
+    target_str = act["target"]
+    cm = act["comment"] if act["comment"] else "(no comment)"
 
-        target_str = act["target"]
-        cm = act["comment"] if act["comment"] else "(no comment)"
-
-        await safe_edit(
-            c,
-            f"{tr(lang, 'sending')}\n\n"
-            f"🎁 {fmt_gift(gift)}\n"
-            f"🎯 {('reply-target' if target_str.startswith('reply:') else target_str)}\n"
-            f"🔒 {fmt_mode(lang, act['hide_name'])}\n"
-            f"💬 {cm}",
-            reply_markup=None
+    # xabar tahriri kosmetik: uning xatosi yuborish holatiga ta'sir qilmasin
+    await _status_edit(
+        c,
+        f"{tr(lang, 'sending')}\n\n"
+        f"🎁 {fmt_gift(gift)}\n"
+        f"🎯 {('reply-target' if target_str.startswith('reply:') else target_str)}\n"
+        f"🔒 {fmt_mode(lang, act['hide_name'])}\n"
+        f"💬 {cm}",
+    )
+
+    try:
+        with timed("send.total"):
+            comment_attached = await execute_action(act, gift, c.from_user.id, c.from_user.username)
+    except Exception as e:
+        await db_mark_action(action_id, "failed", error=str(e))
+        # reply message not found => chiroyli xabar
+        if "REPLY_MESSAGE_NOT_FOUND" in str(e) or "REPLY_SENDER_NOT_FOUND" in str(e):
+            return await _status_edit(c, tr(lang, "reply_fetch_fail"))
+        return await _status_edit(c, tr(lang, "err", e=str(e)))
+
+    await db_mark_action(action_id, "sent", error=None)
+    await _status_edit(c, render_sent(lang, act, gift, comment_attached))
+
+
+async def _status_edit(c: CallbackQuery, text: str):
+    try:
+        await safe_edit(c, text, reply_markup=None)
+    except Exception:
+        log.exception("Status edit failed")
+
+
+async def execute_action(act: dict, gift: GiftItem, me_id: int, me_username: Optional[str]) -> bool:
+    """Resolve the action target and send it through the relayer. Returns comment_attached."""
+    target_str = act["target"]
+
+    async def _send(attempt: SendAttempt) -> bool:
+        await relayer.ensure_ready()
+
+        # TARGET RESOLVE (reply fix)
+        if target_str.startswith("reply:"):
+            _, chat_id_s, msg_id_s = target_str.split(":", 2)
+            chat_id = int(chat_id_s)
+            msg_id = int(msg_id_s)
+            sender_entity = await relayer.resolve_reply_sender(chat_id, msg_id)
+            target_val: Union[str, int, object] = sender_entity
+        else:
+            if target_str.lower() == "me":
+                target_val = f"@{me_username}" if me_username else me_id
+            elif target_str.startswith("@"):
+                target_val = target_str
+            elif target_str.isdigit():
+                target_val = int(target_str)
+            else:
+                target_val = target_str
+
+        return await relayer.send_star_gift(
+            target=target_val,
+            gift=gift,
+            comment=act["comment"],
+            hide_name=(act["hide_name"] == 1),
+            on_step=attempt.step,
         )
 
+    async def _send_in_turn(attempt: SendAttempt) -> bool:
+        async with send_admission.turn():
+            return await _send(attempt)
+
+    return await retry_send(act["action_id"], _send_in_turn)
+
+
+def render_sent(lang: str, act: dict, gift: GiftItem, comment_attached: bool) -> str:
+    target_str = act["target"]
+    final = (
+        f"{tr(lang, 'sent')}\n\n"
+        f"🎁 {fmt_gift(gift)}\n"
+        f"🎯 {('reply-target' if target_str.startswith('reply:') else target_str)}\n"
+        f"🔒 {fmt_mode(lang, act['hide_name'])}\n"
+    )
+    if act["comment"]:
+        final += f"💬 {act['comment']}\n"
+        if not comment_attached:
+            final += "⚠️ comment rejected by Telegram (sent without comment)\n"
+    return final
+
+
+# =========================
+# Scheduled gifts
+# =========================
+class Scheduler:
+    """
+    Fires status='scheduled' actions at their send_at.
+    Only the next SCHED_WINDOW due rows live in the heap; the table is re-read
+    when the heap runs dry, never on a fixed tick. The DB is the source of truth,
+    so restarts just reload it.
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self._heap: List[Tuple[int, int]] = []  # (send_at, action_id)
+        self._ids: set[int] = set()
+        self._complete = False  # heap holds every scheduled row
+        # while incomplete: rows due later than this may be in the table but not in the heap
+        self._horizon = 0
+        self._notified: Optional[List[Tuple[int, int]]] = None  # notifies that arrived during _reload
+        self._resync = False
+        self._failures = 0  # consecutive failed reloads (backoff)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name="scheduler")
+
+    async def stop(self):
+        if self._task:
+            self._wake.set()  # returns on its own once drain.draining is set
+            await asyncio.wait([self._task], timeout=1)
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def notify(self, action_id: int, send_at: int):
+        if self._notified is not None:
+            # the running SELECT may predate this row; merged once the new heap is in place
+            self._notified.append((action_id, send_at))
+            return
+        if action_id in self._ids:
+            return
+        if not self._complete and send_at > self._horizon:
+            # later than the loaded window; picked up on the next reload. Even with an empty
+            # heap: pushing it would stand in for that reload and hide the unloaded rows.
+            return
+        heapq.heappush(self._heap, (send_at, action_id))
+        self._ids.add(action_id)
+        if len(self._heap) > self.window:
+            last = max(self._heap)
+            self._heap.remove(last)
+            heapq.heapify(self._heap)
+            self._ids.discard(last[1])
+            self._complete = False
+            self._horizon = last[0]
+        self._wake.set()
+
+    def resync(self):
+        """Re-read the table soon: another instance may have scheduled rows we never saw."""
+        self._resync = True
+        self._wake.set()
+
+    async def _reload(self):
+        self._notified = []
         try:
-            # TARGET RESOLVE (reply fix)
-            if target_str.startswith("reply:"):
-                _, chat_id_s, msg_id_s = target_str.split(":", 2)
-                chat_id = int(chat_id_s)
-                msg_id = int(msg_id_s)
-                sender_entity = await relayer.resolve_reply_sender(chat_id, msg_id)
-                target_val: Union[str, int, object] = sender_entity
-            else:
-                if target_str.lower() == "me":
-                    target_val = f"@{c.from_user.username}" if c.from_user.username else c.from_user.id
-                elif target_str.startswith("@"):
-                    target_val = target_str
-                elif target_str.isdigit():
-                    target_val = int(target_str)
-                else:
-                    target_val = target_str
-
-            comment_attached = await relayer.send_star_gift(
-                target=target_val,
-                gift=gift,
-                comment=act["comment"],
-                hide_name=(act["hide_name"] == 1),
-            )
+            rows = await db_next_scheduled(self.window)
+        finally:
+            notified, self._notified = self._notified, None
+        self._heap = list(rows)
+        heapq.heapify(self._heap)
+        self._ids = {a for _, a in rows}
+        self._complete = len(rows) < self.window
+        self._horizon = rows[-1][0] if rows else 0
+        for action_id, send_at in notified:
+            self.notify(action_id, send_at)
+
+    async def _try_reload(self) -> bool:
+        # DB xatosi (masalan "database is locked") scheduler'ni o'ldirmasin: log, kutib qayta
+        try:
+            await self._reload()
+        except Exception:
+            self._failures += 1
+            self._resync = True
+            delay = min(SCHED_IDLE_RELOAD, 2 ** self._failures)
+            log.exception("Scheduler reload failed; retrying in %ss", delay)
+            await asyncio.sleep(delay)
+            return False
+        self._failures = 0
+        return True
+
+    async def _run(self):
+        self._resync = True
+        while not drain.draining:
+            if self._resync or (not self._heap and not self._complete):
+                self._resync = False
+                if not await self._try_reload():
+                    continue
+
+            now = time.time()
+            if self._heap and self._heap[0][0] <= now:
+                _, action_id = heapq.heappop(self._heap)
+                self._ids.discard(action_id)
+                try:
+                    with drain.track():
+                        await fire_scheduled_action(action_id)
+                except Exception:
+                    log.exception("Scheduled action %s crashed", action_id)
+                    await asyncio.sleep(1)  # don't spin if the DB itself is failing
+                continue
 
-            await db_mark_action(action_id, "sent", error=None)
+            timeout = (self._heap[0][0] - now) if self._heap else SCHED_IDLE_RELOAD
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if not self._heap:
+                    # rows may have been added outside this process
+                    self._resync = True
 
-            final = (
-                f"{tr(lang, 'sent')}\n\n"
-                f"🎁 {fmt_gift(gift)}\n"
-                f"🎯 {('reply-target' if target_str.startswith('reply:') else target_str)}\n"
-                f"🔒 {fmt_mode(lang, act['hide_name'])}\n"
-            )
-            if act["comment"]:
-                final += f"💬 {act['comment']}\n"
-                if not comment_attached:
-                    final += "⚠️ comment rejected by Telegram (sent without comment)\n"
 
-            await safe_edit(c, final, reply_markup=None)
+async def fire_scheduled_action(action_id: int):
+    with trace(f"act:{action_id}"):
+        await _fire_scheduled_action(action_id)
+
 
+async def _fire_scheduled_action(action_id: int):
+    ok, st = await db_try_lock_sending(action_id, from_status="scheduled")
+    if not ok:
+        return  # cancelled, or already picked up
+
+    act = await db_get_action(action_id)
+    creator = await db_get_admin(act["creator_id"])
+    lang = creator["lang"] if creator else DEFAULT_LANG
+
+    gift = GIFTS_BY_ID.get(act["gift_id"])
+    if not gift:
+        await db_mark_action(action_id, "failed", error="Gift not in catalog")
+        text = tr(lang, "err", e="Gift not found")
+    else:
+        send_admission.admit(shed=False)
+        try:
+            with timed("send.total"):
+                comment_attached = await execute_action(act, gift, act["creator_id"], None)
+            await db_mark_action(action_id, "sent", error=None)
+            text = render_sent(lang, act, gift, comment_attached)
         except Exception as e:
-            # reply message not found => chiroyli xabar
+            await db_mark_action(action_id, "failed", error=str(e))
             if "REPLY_MESSAGE_NOT_FOUND" in str(e) or "REPLY_SENDER_NOT_FOUND" in str(e):
-                await db_mark_action(action_id, "failed", error=str(e))
-                return await safe_edit(c, tr(lang, "reply_fetch_fail"), reply_markup=None)
+                text = tr(lang, "reply_fetch_fail")
+            else:
+                text = tr(lang, "err", e=str(e))
+        finally:
+            send_admission.leave()
 
-            await db_mark_action(action_id, "failed", error=str(e))
-            await safe_edit(c, tr(lang, "err", e=str(e)), reply_markup=None)
+    log.info("Scheduled action %s fired", action_id)
+    if act["chat_id"]:
+        try:
+            await BOTS_BY_ID.get(act["bot_id"], bot).send_message(act["chat_id"], text)
+        except Exception:
+            log.exception("Scheduled action %s: notify failed", action_id)
+
+
+scheduler = Scheduler(SCHED_WINDOW)
+
+
+# =========================
+# HTTP (SSE, ingestion API)
+# =========================
+def _sse(event: str, data: dict, event_id: Optional[str] = None) -> bytes:
+    head = f"id: {event_id}\n" if event_id else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+async def sse_events(request: web.Request) -> web.StreamResponse:
+    """
+    GET /events: `action` events ({action_id, status, ts, ...}) as they happen.
+    Reconnect with Last-Event-ID to resume; `reset` means events were missed
+    (re-read the DB once), `overflow` means this client fell behind and was cut off.
+    """
+    resp = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await resp.prepare(request)
+    sub = events.subscribe(request.headers.get("Last-Event-ID") or request.query.get("last_event_id"))
+    try:
+        await resp.write(b"retry: 2000\n\n")
+        if sub.gap:
+            await resp.write(_sse("reset", {"epoch": events.epoch}))
+        for ev in sub.backlog:
+            await resp.write(_sse("action", ev, ev["id"]))
+        sub.backlog = []
+        while True:
+            try:
+                ev = await asyncio.wait_for(sub.queue.get(), timeout=SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await resp.write(b": ping\n\n")
+                continue
+            if ev is None:
+                await resp.write(_sse("overflow", {"queue": SSE_QUEUE}))
+                break
+            await resp.write(_sse("action", ev, ev["id"]))
+    except ConnectionResetError:
+        pass
+    finally:
+        events.unsubscribe(sub)
+    return resp
+
+
+async def http_stats(request: web.Request) -> web.Response:
+    """GET /stats: send line depth and wait estimate, relayer health, stream and edit counters."""
+    return web.json_response({
+        "sends": send_admission.stats(),
+        "draining": drain.draining,
+        "relayer": relayer.health(),
+        "events": {"subscribers": len(events), "dropped": events.dropped},
+        "edit_outbox": dict(edit_outbox.stats),
+        "db": DB_STATS,
+    })
+
+
+API_TARGET_RE = re.compile(r"^(me|@[A-Za-z0-9_]{4,32}|\d{1,20})$")
+
+
+def parse_api_item(x) -> dict:
+    """One POST /api/actions item -> db_ingest_actions() row. ValueError says what is wrong."""
+    if not isinstance(x, dict):
+        raise ValueError("item must be an object")
+    key = x.get("idempotency_key")
+    if not isinstance(key, str) or not key.strip() or len(key) > 200:
+        raise ValueError("idempotency_key: required string, up to 200 chars")
+
+    raw_target = x.get("target")
+    if not isinstance(raw_target, (str, int)) or isinstance(raw_target, bool) or not str(raw_target).strip():
+        # normalize_target("") => "me": xato yozilgan maydon pullik sovg'ani API_CREATOR_ID ga yuborardi
+        raise ValueError("target: required ('me', @username or numeric id)")
+    target = normalize_target(str(raw_target))
+    if not API_TARGET_RE.match(target):
+        raise ValueError("target: 'me', @username or numeric id")
+
+    if x.get("gift_id") is not None:
+        # katta id'lar JS'da buziladi, shuning uchun string ham qabul qilamiz
+        gid = str(x["gift_id"])
+        gift = GIFTS_BY_ID.get(int(gid)) if gid.isdigit() else None
+        if not gift:
+            raise ValueError("gift_id: not in catalog")
+    elif x.get("max_stars") is not None:
+        ms = x["max_stars"]
+        if not isinstance(ms, int) or isinstance(ms, bool):
+            raise ValueError("max_stars: integer")
+        gifts = gifts_up_to(ms)
+        if not gifts:
+            raise ValueError(f"max_stars: no gift at or below {ms} (cheapest: {ALLOWED_PRICES[0]})")
+        gift = gifts[0]  # /gift bilan bir xil: eng arzon
+    else:
+        raise ValueError("gift_id or max_stars required")
+
+    comment = x.get("comment")
+    if comment is not None and not isinstance(comment, str):
+        raise ValueError("comment: string")
+
+    send_at = x.get("send_at")
+    if isinstance(send_at, str):
+        send_at = parse_send_at(send_at)
+        if send_at is None:
+            raise ValueError("send_at: unix time or 'YYYY-MM-DD HH:MM' / 'HH:MM' / '+2h'")
+    elif send_at is not None and (not isinstance(send_at, int) or isinstance(send_at, bool)):
+        raise ValueError("send_at: unix time or 'YYYY-MM-DD HH:MM' / 'HH:MM' / '+2h'")
+
+    return {
+        "key": key.strip(),
+        "target": target,
+        "gift": gift,
+        "comment": safe_comment(comment),
+        "hide_name": 1 if x.get("hide_name") else 0,
+        "send_at": send_at,
+    }
+
+
+@web.middleware
+async def api_auth(request: web.Request, handler):
+    # API_TOKEN bilan server tashqi servislarga ochiladi: /events va /stats ham (creator id,
+    # xato matnlari) token talab qiladi. Tokensiz faqat /api/ yopiq (127.0.0.1 dagi eski holat)
+    if API_TOKEN or request.path.startswith("/api/"):
+        got = request.headers.get("Authorization", "")
+        if not API_TOKEN or not hmac.compare_digest(got.encode(), f"Bearer {API_TOKEN}".encode()):
+            return web.json_response({"error": "unauthorized"}, status=401)
+    return await handler(request)
+
+
+_api_me: Optional[str] = None
+
+
+async def api_me_target() -> str:
+    """'me' for API actions = API_CREATOR_ID, stored as @username so the relayer can resolve it."""
+    global _api_me
+    if _api_me is None:
+        try:
+            chat = await bot.get_chat(API_CREATOR_ID)
+            _api_me = f"@{chat.username}" if chat.username else str(API_CREATOR_ID)
+        except Exception as e:
+            log.warning("API: can't look up creator %s: %s", API_CREATOR_ID, e)
+            return str(API_CREATOR_ID)
+    return _api_me
+
+
+async def api_create_actions(request: web.Request) -> web.Response:
+    """
+    POST /api/actions {"actions": [{target, gift_id | max_stars, comment, hide_name,
+    idempotency_key, send_at?}, ...]}. All-or-nothing; rows are queued as scheduled
+    (send_at defaults to now) and sent by the scheduler.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"error": "invalid JSON"}, status=400)
+    items = body.get("actions") if isinstance(body, dict) else body
+    if not isinstance(items, list) or not items:
+        return web.json_response({"error": "actions: non-empty list required"}, status=400)
+    if len(items) > API_MAX_BATCH:
+        return web.json_response({"error": f"at most {API_MAX_BATCH} actions per request"}, status=413)
+
+    parsed, errors = [], []
+    for i, x in enumerate(items):
+        try:
+            parsed.append(parse_api_item(x))
+        except ValueError as e:
+            errors.append({"index": i, "error": str(e)})
+    if errors:
+        return web.json_response({"errors": errors}, status=422)
+
+    if any(it["target"] == "me" for it in parsed):
+        me = await api_me_target()
+        for it in parsed:
+            if it["target"] == "me":
+                it["target"] = me
+
+    with timed("api.ingest"):
+        results = await db_ingest_actions(API_CREATOR_ID, parsed)
+    fresh = [r for r in results if not r["duplicate"]]
+    for r in fresh:
+        scheduler.notify(r["action_id"], r["send_at"])
+    log.info("API: %s actions queued, %s duplicates", len(fresh), len(results) - len(fresh))
+    return web.json_response({"actions": results}, status=201 if fresh else 200)
+
+
+async def api_action_status(request: web.Request) -> web.Response:
+    """GET /api/actions/{id} or /api/actions?ids=1,2,3 -> status, error, send_at."""
+    raw = request.match_info.get("action_id") or request.query.get("ids", "")
+    try:
+        ids = [int(x) for x in raw.split(",") if x.strip()]
+    except ValueError:
+        return web.json_response({"error": "ids: comma-separated integers"}, status=400)
+    if not ids or len(ids) > API_MAX_BATCH:
+        return web.json_response({"error": f"1..{API_MAX_BATCH} ids"}, status=400)
+
+    found = await db_action_statuses(API_CREATOR_ID, ids)
+    if "action_id" in request.match_info:
+        if not found:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response(found[ids[0]])
+    return web.json_response({"actions": [found.get(i, {"action_id": i, "status": "missing"}) for i in ids]})
+
+
+class HttpServer:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.app = web.Application(middlewares=[api_auth])
+        self.app.router.add_get("/events", sse_events)
+        self.app.router.add_get("/stats", http_stats)
+        if API_TOKEN:
+            self.app.router.add_post("/api/actions", api_create_actions)
+            self.app.router.add_get("/api/actions", api_action_status)
+            self.app.router.add_get(r"/api/actions/{action_id:\d+}", api_action_status)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if not self.port:
+            if API_TOKEN:
+                log.warning("API_TOKEN is set but HTTP_PORT is 0; the API is not served")
+            return
+        self._runner = web.AppRunner(self.app, shutdown_timeout=1)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("HTTP on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+http = HttpServer(HTTP_HOST, HTTP_PORT)
+
+
+# =========================
+# Drain & handover
+# =========================
+# Each instance holds a lease (instances.heartbeat_at) on the 'sending' rows it
+# locked. Rows whose owner stopped heartbeating are settled by whoever is alive,
+# so a deploy never leaves actions stuck and never sends one twice.
+async def recover_orphans() -> int:
+    alive_since = int(time.time() - 3 * INSTANCE_HEARTBEAT)
+    rows = await db_recover_orphans(alive_since)
+    for action_id, status, send_at in rows:
+        log.warning("Orphaned action %s recovered as %s", action_id, status)
+        if status == "scheduled":
+            scheduler.notify(action_id, send_at)
+    return len(rows)
+
+
+async def heartbeat_loop():
+    peers: set = set()
+    while True:
+        await asyncio.sleep(INSTANCE_HEARTBEAT)
+        try:
+            live = await db_heartbeat(int(time.time() - 3 * INSTANCE_HEARTBEAT))
+            if peers - live:
+                # a previous instance finished draining; pick up what it scheduled meanwhile
+                scheduler.resync()
+            peers = live
+            if not drain.draining:
+                await recover_orphans()
+        except Exception:
+            log.exception("Heartbeat failed")
+
+
+def begin_drain(sig: Optional[signal.Signals] = None):
+    if drain.draining:
+        return
+    drain.draining = True
+    log.info("Draining (%s): polling stopped, %s updates in flight", getattr(sig, "name", "manual"), drain.active)
+    asyncio.ensure_future(_stop_polling())
+
+
+async def _stop_polling():
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        pass  # signal came before polling started; main() skips it
+
+
+async def confirm_offsets():
+    """Acknowledge every update this instance took in, so the next poller starts after them."""
+    for b in bots:
+        last = drain.offsets.get(b.id)
+        if last is None:
+            continue
+        try:
+            await b.get_updates(offset=last + 1, limit=1, timeout=0)
+        except Exception as e:
+            # odatda TelegramConflictError: yangi instance allaqachon poll qilyapti
+            log.warning("Offset handover for bot %s skipped: %s", b.id, e)
+
+
+async def shutdown(hb: asyncio.Task):
+    drain.draining = True
+    if not await drain.wait(DRAIN_TIMEOUT):
+        log.warning("Drain deadline hit with %s updates/sends in flight; the next instance will settle them",
+                    drain.active)
+    await scheduler.stop()
+    await http.stop()
+    await admission.stop()
+    await settings_wb.stop()
+    await confirm_offsets()
+    await relayer.stop()
+    hb.cancel()
+    await db_drop_instance()
+    await asyncio.gather(*(b.session.close() for b in bots), return_exceptions=True)
+    log.info("Drained")
 
 
 # =========================
 # Main
 # =========================
 async def main():
+    require_bot_env()
     log.info("BOOT: starting...")
     await db_init()
-    log.info("BOOT: db_init OK")
+    await db_heartbeat(int(time.time() - 3 * INSTANCE_HEARTBEAT))
+    recovered = await recover_orphans()
+    await admission.refresh()
+    log.info("BOOT: db_init OK | instance=%s recovered=%s admins=%s", INSTANCE_ID, recovered, len(admission.ids))
 
     me = await relayer.start()
     log.info("Relayer OK | id=%s username=%s", getattr(me, "id", None), getattr(me, "username", None))
 
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, begin_drain, sig)
+        except NotImplementedError:  # Windows
+            pass
+
+    scheduler.start()
+    settings_wb.start()
+    admission.start()
+    await http.start()
+    hb = asyncio.create_task(heartbeat_loop(), name="heartbeat")
     try:
-        log.info("Polling...")
-        await dp.start_polling(bot)
+        if not drain.draining:
+            allowed = dp.resolve_used_update_types()
+            log.info("Polling... | allowed_updates=%s", ",".join(allowed))
+            # signals and session closing are ours: in-flight handlers still need the sessions
+            await dp.start_polling(*bots, allowed_updates=allowed, handle_signals=False, close_bot_session=False)
     finally:
-        await relayer.stop()
+        await shutdown(hb)
+
+
+async def cli_export(args: argparse.Namespace):
+    await db_init()
+    ts_from, ts_to = export_range(args.date_from, args.date_to)
+    out = args.out or f"actions_{fmt_ts(ts_from)[:10]}_{fmt_ts(ts_to - 1)[:10]}.{args.format}.gz"
+    n = await export_actions(out, ts_from, ts_to, args.format)
+    log.info("Exported %s rows to %s", n, out)
+
+
+def cli():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd")
+    ex = sub.add_parser("export", help="dump the actions ledger to gzip CSV/NDJSON")
+    ex.add_argument("--from", dest="date_from", help="YYYY-MM-DD (default: previous month)")
+    ex.add_argument("--to", dest="date_to", help="YYYY-MM-DD, inclusive")
+    ex.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    ex.add_argument("--out", help="output path (default: actions_<from>_<to>.<format>.gz)")
+    args = ap.parse_args()
+
+    if args.cmd == "export":
+        try:
+            export_range(args.date_from, args.date_to)
+        except ValueError as e:
+            ap.error(f"export: {e}")
+        asyncio.run(cli_export(args))
+    else:
+        asyncio.run(main())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    cli()
@@ -0,0 +1,249 @@
+"""
+Replay recorded update traffic (RECORD_UPDATES=... python main.py) against
+stubbed Bot API and relayer backends, and report handler latency and DB writes.
+
+    python replay.py updates.jsonl                 # real-time (1x)
+    python replay.py updates.jsonl --speed 10      # 10x faster
+    python replay.py updates.jsonl --speed 0       # as fast as possible
+    python replay.py updates.jsonl --json > a.json # machine-readable, to diff builds
+
+Runs on a throw-away SQLite file; never touches the real DB or Telegram.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from toolenv import placeholder_env, pct
+
+
+async def run(args) -> dict:
+    import main
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Update, Message, Chat, User
+
+    api_calls: Counter = Counter()
+
+    class StubSession(BaseSession):
+        """Answers every Bot API method locally after --api-latency."""
+
+        async def make_request(self, bot, method, timeout=None):
+            name = type(method).__name__
+            api_calls[name] += 1
+            if args.api_latency:
+                await asyncio.sleep(args.api_latency)
+            returning = method.__returning__
+            if returning is User:
+                return User(id=bot.id, is_bot=True, first_name="replay", username="replay_bot")
+            if returning is Message:
+                chat_id = getattr(method, "chat_id", 0) or 0
+                return Message(
+                    message_id=api_calls[name],
+                    date=datetime.now(timezone.utc),
+                    chat=Chat(id=int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, type="private"),
+                    text=getattr(method, "text", None),
+                )
+            return True
+
+        async def stream_content(self, *a, **kw):
+            if False:
+                yield b""
+
+        async def close(self):
+            pass
+
+    class StubRelayer:
+        """Same surface as Relayer; sends are serialized and take --relayer-latency."""
+
+        def __init__(self):
+            self._lock = asyncio.Lock()
+            self.sends = 0
+
+        async def start(self):
+            return None
+
+        async def stop(self):
+            pass
+
+        async def ensure_ready(self):
+            pass
+
+        def health(self) -> dict:
+            return {"connected": True, "warm": True, "dcs": {}}
+
+        async def resolve_reply_sender(self, chat_id: int, msg_id: int):
+            async with self._lock:
+                await asyncio.sleep(args.relayer_latency / 4)
+                return msg_id
+
+        async def send_star_gift(self, *, target, gift, comment, hide_name, on_step=None) -> bool:
+            async with self._lock:
+                for step in ("check", "resolve", "form", "charge"):
+                    if on_step:
+                        await on_step(step)
+                    await asyncio.sleep(args.relayer_latency / 4)
+                self.sends += 1
+                return bool(comment)
+
+    for b in main.bots:
+        b.session = StubSession()
+    main.relayer = StubRelayer()
+
+    with open(args.path, encoding="utf-8") as f:
+        lines = [json.loads(x) for x in f if x.strip()]
+    lines.sort(key=lambda x: x["t"])
+
+    await main.db_init()
+    if args.admins == "all":
+        senders = set()
+        for ln in lines:
+            u = ln["update"]
+            for kind in ("message", "callback_query", "inline_query"):
+                if kind in u and "from" in u[kind]:
+                    senders.add(u[kind]["from"]["id"])
+        async with main.db_connect() as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO admins(user_id, role, lang, created_at) VALUES(?,?,?,?)",
+                [(uid, "admin", main.DEFAULT_LANG, int(time.time())) for uid in senders],
+            )
+            await db.commit()
+    db_before = dict(main.DB_STATS)
+    main.settings_wb.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Counter = Counter()
+
+    # recorded callbacks carry production action ids; map them to the ids this run creates.
+    # Lines list what their update created ("created"), in creation order.
+    loop = asyncio.get_running_loop()
+    remap: Dict[int, asyncio.Future] = {}
+    for ln in lines:
+        for prod_id in ln.get("created", ()):
+            remap[prod_id] = loop.create_future()
+    unmapped = 0
+
+    async def rewrite_callback(raw: dict):
+        nonlocal unmapped
+        cq = raw.get("callback_query")
+        parts = (cq or {}).get("data", "").split(":")
+        if len(parts) != 3 or parts[0] != "act" or not parts[2].isdigit():
+            return
+        fut = remap.get(int(parts[2]))
+        if fut is None:
+            unmapped += 1  # recorded before "created" existed; stays already_done
+            return
+        try:
+            # the creating update may still be in flight at --speed 0
+            new_id = await asyncio.wait_for(asyncio.shield(fut), timeout=30)
+        except asyncio.TimeoutError:
+            unmapped += 1
+            return
+        cq["data"] = f"act:{parts[1]}:{new_id}"
+
+    async def feed(ln: dict):
+        raw = copy.deepcopy(ln["update"])
+        await rewrite_callback(raw)
+        upd = Update.model_validate(raw, context={"bot": main.bot})
+        kind = upd.event_type
+        created: List[int] = []
+        token = main.created_ids_var.set(created)
+        t0 = time.perf_counter()
+        try:
+            await main.dp.feed_update(main.bot, upd)
+        except asyncio.CancelledError:
+            kind += ":superseded"
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        finally:
+            main.created_ids_var.reset(token)
+        latencies[kind].append((time.perf_counter() - t0) * 1000)
+        for prod_id, new_id in zip(ln.get("created", ()), created):
+            if not remap[prod_id].done():
+                remap[prod_id].set_result(new_id)
+
+    start = time.monotonic()
+    base = lines[0]["t"] if lines else 0.0
+    tasks = []
+    for ln in lines:
+        if args.speed > 0:
+            due = (ln["t"] - base) / args.speed
+            delay = due - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(ln)))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    wall = time.monotonic() - start
+    await main.settings_wb.stop()
+
+    return {
+        "updates": len(lines),
+        "wall_s": round(wall, 3),
+        "speed": args.speed,
+        "latency_ms": {
+            k: {
+                "n": len(v),
+                "p50": round(pct(v, 50), 2),
+                "p95": round(pct(v, 95), 2),
+                "p99": round(pct(v, 99), 2),
+                "max": round(max(v), 2),
+            }
+            for k, v in sorted(latencies.items())
+        },
+        "db": {k: main.DB_STATS[k] - db_before.get(k, 0) for k in main.DB_STATS},
+        "bot_api_calls": dict(api_calls.most_common()),
+        "edit_outbox": dict(main.edit_outbox.stats),
+        "relayer_sends": main.relayer.sends,
+        "unmapped_callbacks": unmapped,
+        "errors": dict(errors),
+    }
+
+
+def print_report(r: dict):
+    speed = f"{r['speed']}x" if r["speed"] else "max"
+    print(f"updates: {r['updates']}  wall: {r['wall_s']}s  speed: {speed}")
+    print("\nhandler latency (ms):")
+    print(f"  {'type':<28}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for k, v in r["latency_ms"].items():
+        print(f"  {k:<28}{v['n']:>7}{v['p50']:>10}{v['p95']:>10}{v['p99']:>10}{v['max']:>10}")
+    print("\ndb:", ", ".join(f"{k}={v}" for k, v in r["db"].items()))
+    print("bot api:", ", ".join(f"{k}={v}" for k, v in r["bot_api_calls"].items()) or "-")
+    print("edit outbox:", ", ".join(f"{k}={v}" for k, v in r["edit_outbox"].items()))
+    print("relayer sends:", r["relayer_sends"])
+    if r["unmapped_callbacks"]:
+        print("unmapped callbacks (no recorded action ids):", r["unmapped_callbacks"])
+    if r["errors"]:
+        print("errors:", ", ".join(f"{k}={v}" for k, v in r["errors"].items()))
+
+
+def cli(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("path", help="JSONL written with RECORD_UPDATES")
+    ap.add_argument("--speed", type=float, default=1.0, help="time scale; 0 = no delays")
+    ap.add_argument("--api-latency", type=float, default=0.05, help="stub Bot API latency, s")
+    ap.add_argument("--relayer-latency", type=float, default=0.8, help="stub gift send latency, s")
+    ap.add_argument("--admins", choices=("all", "none"), default="all",
+                    help="seed every sender as admin (default) or only the owner")
+    ap.add_argument("--db", help="SQLite file to use (default: temporary)")
+    ap.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        placeholder_env(args.db or os.path.join(tmp, "replay.db"))
+        report = asyncio.run(run(args))
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,30 @@
+"""
+Shared setup for the offline tools (replay.py, bench_storage.py): main.py
+reads its config at import, so they point it at a throw-away DB first.
+"""
+import os
+from typing import List
+
+from telethon.sessions import StringSession
+from telethon.crypto import AuthKey
+
+
+def placeholder_env(db_path: str):
+    # main.py reads these at import; the tools stub out Bot API / relayer, so the values are unused
+    os.environ["DB_PATH"] = db_path
+    os.environ.setdefault("BOT_TOKEN", "1:replay")
+    os.environ.setdefault("TG_API_ID", "1")
+    os.environ.setdefault("TG_API_HASH", "replay")
+    if not os.environ.get("RELAYER_SESSION"):
+        ss = StringSession()
+        ss.set_dc(2, "127.0.0.1", 443)
+        ss.auth_key = AuthKey(bytes(256))
+        os.environ["RELAYER_SESSION"] = ss.save()
+    os.environ.pop("RECORD_UPDATES", None)
+
+
+def pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]